@@ -0,0 +1,77 @@
+"""Shared setup for the benchmarks in this directory.
+
+Every script loads the backend against a throwaway database. Run them from the
+backend directory, e.g. `python bench/login_storm.py`. To get the "before"
+number for a change, point BENCH_BACKEND at a checkout of the commit before it:
+
+    git worktree add /tmp/before <commit>^
+    BENCH_BACKEND=/tmp/before/backend python bench/login_storm.py
+"""
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+import warnings
+
+BACKEND = os.path.abspath(os.environ.get("BENCH_BACKEND") or os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def load_main():
+    """Import the backend with its database and image store in a temp directory"""
+    warnings.filterwarnings("ignore")
+    scratch = tempfile.mkdtemp(prefix="bench-")
+    os.environ.setdefault("GEMINI_API_KEY", "bench")
+    os.environ.setdefault("IMAGE_STORE_DIR", os.path.join(scratch, "images"))
+    os.environ.setdefault("RATE_LIMIT_DB", os.path.join(scratch, "ratelimit.db"))
+    sys.path.insert(0, BACKEND)
+    import main
+    main.DATABASE_PATH = os.path.join(scratch, "bench.db")
+    return main
+
+
+def sign_up(client, email=None, password="pw"):
+    """Register and log in through the API; returns the bearer token"""
+    email = email or f"{uuid.uuid4().hex}@bench.io"
+    r = client.post("/register", json={"email": email, "username": "bench", "password": password})
+    assert r.status_code in (200, 400), r.text
+    r = client.post("/login", json={"email": email, "password": password})
+    assert r.status_code == 200, r.text
+    return r.json()["access_token"]
+
+
+async def sign_up_async(client, email=None, password="pw"):
+    email = email or f"{uuid.uuid4().hex}@bench.io"
+    r = await client.post("/register", json={"email": email, "username": "bench", "password": password})
+    assert r.status_code in (200, 400), r.text
+    r = await client.post("/login", json={"email": email, "password": password})
+    assert r.status_code == 200, r.text
+    return r.json()["access_token"]
+
+
+def start_server(script, port):
+    """Run `script serve <port>` under uvicorn in a subprocess and wait until it accepts connections"""
+    proc = subprocess.Popen([sys.executable, script, "serve", str(port)])
+    deadline = time.monotonic() + 60
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return proc
+        except OSError:
+            if proc.poll() is not None or time.monotonic() > deadline:
+                proc.kill()
+                raise RuntimeError(f"{script} did not start listening on port {port}")
+            time.sleep(0.1)
+
+
+def stop_server(proc):
+    proc.terminate()
+    proc.wait(timeout=30)
+
+
+def percentile(samples, q):
+    """The q-th quantile (0-1) of samples, in milliseconds"""
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))] * 1000
@@ -0,0 +1,61 @@
+"""Throughput of concurrent POST /generate calls with a stubbed Gemini.
+
+The stub takes DELAY seconds per completion, both as the sync
+generate_content and as generate_content_async, so the same script measures
+a backend that blocks the event loop on Gemini and one that awaits it.
+One worker, in-process ASGI transport, rate limiting switched off.
+
+    python bench/gemini_concurrency.py [requests]
+"""
+import asyncio
+import json
+import sys
+import time
+
+import httpx
+from fastapi.testclient import TestClient
+
+from common import load_main, sign_up
+
+DELAY = 0.2
+COMPLETION = json.dumps({"script": "bench", "image_prompt": ""})
+
+
+class Completion:
+    text = COMPLETION
+
+
+class StubModel:
+    def generate_content(self, *args, **kwargs):
+        time.sleep(DELAY)
+        return Completion()
+
+    async def generate_content_async(self, *args, **kwargs):
+        await asyncio.sleep(DELAY)
+        return Completion()
+
+
+async def no_limit(*args, **kwargs):
+    pass
+
+
+async def burst(main, token, n):
+    headers = {"Authorization": f"Bearer {token}"}
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://bench") as client:
+        started = time.perf_counter()
+        responses = await asyncio.gather(*[
+            client.post("/generate", json={"brand_name": "bench", "topic": "bench", "fresh": True}, headers=headers)
+            for _ in range(n)])
+        elapsed = time.perf_counter() - started
+    assert all(r.status_code == 200 for r in responses), responses[0].text
+    print(f"{n} concurrent /generate with a {DELAY * 1000:.0f} ms Gemini: {elapsed:.2f}s ({n / elapsed:.1f} req/s)")
+
+
+if __name__ == "__main__":
+    main = load_main()
+    main.genai.GenerativeModel = lambda *args, **kwargs: StubModel()
+    main.check_rate_limit = lambda *args, **kwargs: None
+    main.check_rate_limit_async = no_limit
+    with TestClient(main.app) as client:
+        token = sign_up(client)
+        asyncio.run(burst(main, token, int(sys.argv[1]) if len(sys.argv) > 1 else 40))
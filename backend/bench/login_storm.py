@@ -0,0 +1,68 @@
+"""Login storm: N concurrent /login calls while GET /brands is probed every 20 ms.
+
+Measures how much a burst of password hashing slows everything else down.
+Runs the app under uvicorn (one worker) in a subprocess on PORT.
+
+    python bench/login_storm.py [logins]
+"""
+import asyncio
+import os
+import statistics
+import sys
+import time
+from collections import Counter
+
+import httpx
+
+from common import load_main, percentile, sign_up_async, start_server, stop_server
+
+PORT = int(os.getenv("BENCH_PORT", "8766"))
+EMAIL = "storm@bench.io"
+
+
+async def storm(logins):
+    limits = httpx.Limits(max_connections=logins + 50)
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{PORT}", timeout=120, limits=limits) as client:
+        headers = {"Authorization": f"Bearer {await sign_up_async(client, EMAIL)}"}
+        idle = []
+        for _ in range(30):
+            started = time.perf_counter()
+            await client.get("/brands", headers=headers)
+            idle.append(time.perf_counter() - started)
+
+        probes, done = [], asyncio.Event()
+
+        async def probe():
+            while not done.is_set():
+                started = time.perf_counter()
+                await client.get("/brands", headers=headers)
+                probes.append(time.perf_counter() - started)
+                await asyncio.sleep(0.02)
+
+        async def login():
+            r = await client.post("/login", json={"email": EMAIL, "password": "pw"})
+            return r.status_code
+
+        prober = asyncio.create_task(probe())
+        started = time.perf_counter()
+        codes = Counter(await asyncio.gather(*[login() for _ in range(logins)]))
+        elapsed = time.perf_counter() - started
+        done.set()
+        await prober
+
+    print(f"idle /brands p50 {statistics.median(idle) * 1000:.0f} ms")
+    print(f"{logins} logins in {elapsed:.1f}s, status codes {dict(codes)}")
+    print(f"/brands during the storm: p50 {percentile(probes, .5):.0f} ms, p95 {percentile(probes, .95):.0f} ms, "
+          f"max {max(probes) * 1000:.0f} ms ({len(probes)} probes)")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["serve"]:
+        import uvicorn
+        uvicorn.run(load_main().app, port=int(sys.argv[2]), log_level="warning")
+    else:
+        server = start_server(__file__, PORT)
+        try:
+            asyncio.run(storm(int(sys.argv[1]) if len(sys.argv) > 1 else 150))
+        finally:
+            stop_server(server)
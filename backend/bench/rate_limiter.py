@@ -0,0 +1,91 @@
+"""Rate limiter microbenchmark: the old list-of-datetimes limiter against both GCRA backends.
+
+300k checks over 100k distinct keys at 20/min, then one hot key. Memory is
+measured in a separate tracemalloc pass so it doesn't skew the timings. The
+last check has four processes share one 30/min SQLite bucket.
+
+    python bench/rate_limiter.py
+"""
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+from common import load_main
+
+KEYS = [f"user-{i}" for i in range(100_000)]
+MAX_CALLS, WINDOW = 20, 60
+
+
+def list_per_key(store, key, max_calls=MAX_CALLS, window_seconds=WINDOW):
+    """check_rate_limit as it was before GCRA; True if the call is allowed"""
+    now = datetime.utcnow()
+    if key not in store:
+        store[key] = []
+    store[key] = [t for t in store[key] if (now - t).total_seconds() < window_seconds]
+    if len(store[key]) >= max_calls:
+        return False
+    store[key].append(now)
+    return True
+
+
+def key_sequence(calls):
+    rng = random.Random(1)
+    return [KEYS[rng.randrange(len(KEYS))] for _ in range(calls)]
+
+
+def per_check(check, keys):
+    started = time.perf_counter()
+    for key in keys:
+        check(key)
+    return (time.perf_counter() - started) / len(keys) * 1e6
+
+
+def traced_mib(check, keys):
+    tracemalloc.start()
+    try:
+        for key in keys:
+            check(key)
+        return tracemalloc.get_traced_memory()[0] / 2 ** 20
+    finally:
+        tracemalloc.stop()
+
+
+def shared_bucket_worker(path, results):
+    limiter = load_main().SQLiteRateLimiter(path)
+    results.put(sum(limiter.hit("shared", 30, 60) == 0 for _ in range(50)))
+
+
+if __name__ == "__main__":
+    main = load_main()
+    scratch = tempfile.mkdtemp(prefix="bench-")
+    keys = key_sequence(300_000)
+
+    old = {}
+    memory = main.MemoryRateLimiter()
+    sqlite = main.SQLiteRateLimiter(os.path.join(scratch, "timing.db"))
+    print(f"old list-per-key  {per_check(lambda k: list_per_key(old, k), keys):6.2f} us/check")
+    print(f"GCRA memory       {per_check(lambda k: memory.hit(k, MAX_CALLS, WINDOW), keys):6.2f} us/check")
+    print(f"GCRA sqlite       {per_check(lambda k: sqlite.hit(k, MAX_CALLS, WINDOW), keys[:100_000]):6.2f} us/check")
+
+    hot = ["hot"] * 100_000
+    old_hot = {}
+    print(f"one hot key: old  {per_check(lambda k: list_per_key(old_hot, k), hot):6.2f} us/check")
+    print(f"one hot key: GCRA {per_check(lambda k: memory.hit(k, MAX_CALLS, WINDOW), hot):6.2f} us/check")
+
+    old = {}
+    print(f"old list-per-key  {traced_mib(lambda k: list_per_key(old, k), keys):6.1f} MiB")
+    memory = main.MemoryRateLimiter()
+    print(f"GCRA memory       {traced_mib(lambda k: memory.hit(k, MAX_CALLS, WINDOW), keys):6.1f} MiB")
+
+    results = multiprocessing.Queue()
+    path = os.path.join(scratch, "shared.db")
+    workers = [multiprocessing.Process(target=shared_bucket_worker, args=(path, results)) for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    print(f"4 processes x 50 calls on one 30/min sqlite bucket: {sum(results.get() for _ in workers)} allowed")
@@ -0,0 +1,58 @@
+"""Throughput of authenticated GETs against a seeded database.
+
+2000 requests, 32 in flight, through the in-process ASGI transport, for a user
+with 200 generations and 10 brands. The per-user response cache is off
+(RESPONSE_CACHE_TTL=0) so every request reaches SQLite.
+
+    python bench/read_throughput.py [path ...]
+"""
+import asyncio
+import os
+import sys
+import time
+import uuid
+
+import httpx
+from fastapi.testclient import TestClient
+
+from common import load_main, sign_up
+
+REQUESTS, IN_FLIGHT = 2000, 32
+
+
+def seed(main, user_id):
+    conn = main.get_db()
+    try:
+        for i in range(200):
+            conn.execute("INSERT INTO generations (id, user_id, brand_name, platform, script) VALUES (?, ?, ?, ?, ?)",
+                         (str(uuid.uuid4()), user_id, f"brand {i % 5}", "Instagram", "x" * 500))
+        for i in range(10):
+            conn.execute("INSERT INTO brands (id, user_id, name) VALUES (?, ?, ?)", (str(uuid.uuid4()), user_id, f"brand {i}"))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+async def throughput(main, token, path):
+    headers = {"Authorization": f"Bearer {token}"}
+    gate = asyncio.Semaphore(IN_FLIGHT)
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://bench") as client:
+        async def get():
+            async with gate:
+                r = await client.get(path, headers=headers)
+                assert r.status_code == 200, r.text
+
+        started = time.perf_counter()
+        await asyncio.gather(*[get() for _ in range(REQUESTS)])
+        elapsed = time.perf_counter() - started
+    print(f"{path:20s} {REQUESTS / elapsed:6.0f} req/s")
+
+
+if __name__ == "__main__":
+    os.environ["RESPONSE_CACHE_TTL"] = "0"
+    main = load_main()
+    with TestClient(main.app) as client:
+        token = sign_up(client)
+        seed(main, main.decode_token(token)["user_id"])
+        for path in sys.argv[1:] or ["/history?limit=50", "/brands"]:
+            asyncio.run(throughput(main, token, path))
@@ -0,0 +1,57 @@
+"""decode_token with and without the verified-token cache.
+
+First the bare call on one token, then a trivial authenticated endpoint
+through the in-process ASGI transport, where the saving has to show up
+against the rest of the request.
+
+    python bench/token_cache.py
+"""
+import asyncio
+import time
+
+import httpx
+from fastapi import Depends
+
+from common import load_main
+
+CALLS, REQUESTS = 200_000, 5000
+
+
+def per_call(main, token):
+    started = time.perf_counter()
+    for _ in range(CALLS):
+        main.decode_token(token)
+    return (time.perf_counter() - started) / CALLS * 1e6
+
+
+async def per_request(main, token):
+    headers = {"Authorization": f"Bearer {token}"}
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://bench") as client:
+        for _ in range(300):
+            await client.get("/_whoami", headers=headers)
+        started = time.perf_counter()
+        for _ in range(REQUESTS):
+            await client.get("/_whoami", headers=headers)
+        return (time.perf_counter() - started) / REQUESTS * 1e6
+
+
+def with_cache_size(main, size):
+    main.TOKEN_CACHE_SIZE = size
+    main._verified_tokens.clear()
+
+
+if __name__ == "__main__":
+    main = load_main()
+
+    @main.app.get("/_whoami")
+    async def whoami(user=Depends(main.get_current_user)):
+        return {"user_id": user["user_id"]}
+
+    token = main.create_token("bench-user", "bench")
+    for size, label in ((0, "uncached"), (10000, "cached")):
+        with_cache_size(main, size)
+        print(f"decode_token {label:8s}  {per_call(main, token):6.2f} us")
+    for _ in range(3):
+        for size, label in ((0, "uncached"), (10000, "cached")):
+            with_cache_size(main, size)
+            print(f"GET /_whoami {label:8s}  {asyncio.run(per_request(main, token)):6.0f} us/request")
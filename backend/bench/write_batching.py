@@ -0,0 +1,137 @@
+"""Group commit through db_writer against one commit per write.
+
+`db` (the default) runs the create_campaign unit of work (insert + award_xp)
+from 32 threads for a few seconds, once committing after each write on a
+pooled connection as request handlers used to, and once through
+db_writer.run. Both at synchronous=NORMAL and FULL.
+
+`http` runs 32 clients against uvicorn for POST /brands, /campaigns and
+/generate (with a stubbed Gemini and no image fetches).
+
+    python bench/write_batching.py [db|http]
+"""
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+
+import httpx
+
+from common import load_main, percentile, sign_up_async, start_server, stop_server
+
+THREADS, SECONDS = 32, 4
+PORT = int(os.getenv("BENCH_PORT", "8767"))
+
+
+def units_per_second(op):
+    done, errors = [0] * THREADS, []
+    end = time.perf_counter() + SECONDS
+
+    def run(i):
+        while time.perf_counter() < end:
+            try:
+                op()
+                done[i] += 1
+            except Exception as e:
+                errors.append(repr(e))
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(done) / SECONDS, errors
+
+
+def db_level():
+    main = load_main()
+    main.init_db()
+    user_id = str(uuid.uuid4())
+    main.db_writer.run(lambda conn: conn.execute(
+        "INSERT INTO users (id, username, email, password_hash) VALUES (?, 'bench', ?, 'x')", (user_id, user_id)))
+
+    def create_campaign(conn):
+        conn.execute("INSERT INTO campaigns (id, user_id, name) VALUES (?, ?, ?)", (str(uuid.uuid4()), user_id, "bench"))
+        main.award_xp(conn, user_id, 50, "campaign_created")
+
+    def commit_per_write():
+        conn = main.get_db()
+        try:
+            conn.execute("INSERT INTO campaigns (id, user_id, name) VALUES (?, ?, ?)", (str(uuid.uuid4()), user_id, "bench"))
+            conn.commit()
+            main.award_xp(conn, user_id, 50, "campaign_created")
+            conn.commit()
+        finally:
+            conn.close()
+
+    connect = main.ConnectionPool._connect
+    for synchronous in ("NORMAL", "FULL"):
+        def with_synchronous(pool, synchronous=synchronous):
+            conn = connect(pool)
+            conn.execute(f"PRAGMA synchronous={synchronous}")
+            return conn
+
+        main.db_writer.stop()
+        main._db_pool.close_all()
+        main._db_pool = None
+        main.ConnectionPool._connect = with_synchronous
+        for label, op in (("commit per write", commit_per_write), ("db_writer", lambda: main.db_writer.run(create_campaign))):
+            rate, errors = units_per_second(op)
+            print(f"synchronous={synchronous:6s} {label:16s} {rate:6.0f} units/s  errors {len(errors)} {errors[:1]}")
+    main.db_writer.stop()
+
+
+class Completion:
+    text = json.dumps({"script": "bench", "image_prompt": "bench"})
+
+
+class StubModel:
+    async def generate_content_async(self, *args, **kwargs):
+        return Completion()
+
+
+async def http_level():
+    limits = httpx.Limits(max_connections=THREADS * 2)
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{PORT}", timeout=60, limits=limits) as client:
+        tokens = [await sign_up_async(client) for _ in range(THREADS)]
+        for path, body in (("/brands", {"name": "bench"}),
+                           ("/campaigns", {"name": "bench", "start_date": "2026-11-01", "end_date": "2026-11-07"}),
+                           ("/generate", {"brand_name": "bench", "topic": "bench", "fresh": True})):
+            ok, statuses, latencies = 0, Counter(), []
+            end = time.perf_counter() + SECONDS
+
+            async def writer(token):
+                nonlocal ok
+                headers = {"Authorization": f"Bearer {token}"}
+                while time.perf_counter() < end:
+                    started = time.perf_counter()
+                    r = await client.post(path, json=body, headers=headers)
+                    latencies.append(time.perf_counter() - started)
+                    ok += r.status_code == 200
+                    statuses[r.status_code] += r.status_code != 200
+
+            await asyncio.gather(*[writer(token) for token in tokens])
+            print(f"POST {path:10s} {ok / SECONDS:5.0f} writes/s  p50 {percentile(latencies, .5):4.0f} ms  "
+                  f"p99 {percentile(latencies, .99):4.0f} ms  non-200 {dict(+statuses)}")
+
+
+if __name__ == "__main__":
+    mode = sys.argv[1] if len(sys.argv) > 1 else "db"
+    if mode == "serve":
+        import uvicorn
+        main = load_main()
+        main.POLLINATIONS_API_KEY = None
+        main.genai.GenerativeModel = lambda *args, **kwargs: StubModel()
+        uvicorn.run(main.app, port=int(sys.argv[2]), log_level="warning")
+    elif mode == "http":
+        server = start_server(__file__, PORT)
+        try:
+            asyncio.run(http_level())
+        finally:
+            stop_server(server)
+    else:
+        db_level()
@@ -6,13 +6,30 @@ import hashlib
 import secrets
 import urllib.parse
 import base64
+import binascii
+import re
+import html
 import traceback
+import asyncio
+import queue
+import threading
+import time
+import heapq
+import itertools
+import contextvars
+import multiprocessing
+import concurrent.futures
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
-from contextlib import contextmanager
+from contextlib import contextmanager, asynccontextmanager
+from collections import OrderedDict, deque
 
-import requests
+import httpx
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 from fastapi import FastAPI, HTTPException, Depends, Request
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel
@@ -26,17 +43,200 @@ GENAI_KEY = os.getenv("GEMINI_API_KEY")
 POLLINATIONS_API_KEY = os.getenv("POLLINATIONS_API_KEY")
 JWT_SECRET = os.getenv("JWT_SECRET", secrets.token_hex(32))
 DATABASE_PATH = os.path.join(os.path.dirname(__file__), "content_studio.db")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "300"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_USER_CONCURRENCY = int(os.getenv("JOB_USER_CONCURRENCY", "3"))  # running jobs per user
+GENERATION_CACHE_TTL = int(os.getenv("GENERATION_CACHE_TTL", "0"))  # seconds; 0 leaves the cache off
+GENERATION_CACHE_SIZE = int(os.getenv("GENERATION_CACHE_SIZE", "256"))
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "30"))  # seconds; bounds staleness from other worker processes; 0 disables
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "4096"))  # cached per-user responses
+RESPONSE_CACHE_MB = int(os.getenv("RESPONSE_CACHE_MB", "32"))  # memory cap for their bodies
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "40"))  # matches the default anyio threadpool
+DB_WRITE_BATCH = int(os.getenv("DB_WRITE_BATCH", "256"))  # most units of work folded into one commit
+IMAGE_STORE_DIR = os.getenv("IMAGE_STORE_DIR", os.path.join(os.path.dirname(__file__), "images"))
+GEMINI_MODEL_NAME = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "16"))
+POLLINATIONS_BASE_URL = os.getenv("POLLINATIONS_BASE_URL", "https://gen.pollinations.ai")
+POLLINATIONS_MAX_CONNECTIONS = int(os.getenv("POLLINATIONS_MAX_CONNECTIONS", "20"))
+GENERATION_DEADLINE = float(os.getenv("GENERATION_DEADLINE", "45"))  # seconds /generate waits before deferring images
+IMAGE_DEFER_SECONDS = float(os.getenv("IMAGE_DEFER_SECONDS", "300"))  # a deferred image that hasn't landed by then is reported failed
+IMAGE_HEDGING = os.getenv("IMAGE_HEDGING", "0") == "1"  # re-send image fetches that outlive the recent p95
+PASSWORD_ITERATIONS = int(os.getenv("PASSWORD_ITERATIONS", "100000"))  # PBKDF2-SHA256; older hashes upgrade on login
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+PASSWORD_QUEUE = int(os.getenv("PASSWORD_QUEUE", "64"))  # hashes allowed to wait for a worker before answering 503
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))  # verified tokens kept per worker; 0 disables
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")  # "sqlite" shares limits between worker processes
+RATE_LIMIT_DB = os.getenv("RATE_LIMIT_DB", os.path.join(os.path.dirname(__file__), "ratelimit.db"))
+ANALYTICS_RETENTION_DAYS = int(os.getenv("ANALYTICS_RETENTION_DAYS", "30"))  # raw events kept; older ones become hourly counts; 0 keeps all
+ANALYTICS_HOURLY_DAYS = int(os.getenv("ANALYTICS_HOURLY_DAYS", "180"))  # hourly counts kept before folding into daily ones
+ANALYTICS_COMPACT_INTERVAL = int(os.getenv("ANALYTICS_COMPACT_INTERVAL", "3600"))  # seconds between compaction passes
+ANALYTICS_COMPACT_BATCH = int(os.getenv("ANALYTICS_COMPACT_BATCH", "500"))  # rows per compaction transaction
 
 if GENAI_KEY:
     genai.configure(api_key=GENAI_KEY)
 
 # ---------- DATABASE ----------
-def get_db():
-    conn = sqlite3.connect(DATABASE_PATH)
-    conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA journal_mode=WAL")
-    conn.execute("PRAGMA foreign_keys=ON")
-    return conn
+class PooledConnection:
+    """A pooled sqlite3 connection; close() hands it back to the pool instead of closing it"""
+    def __init__(self, conn: sqlite3.Connection, pool: "ConnectionPool"):
+        self._conn = conn
+        self._pool = pool
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self):
+        if self._conn is not None:
+            self._pool.release(self._conn)
+            self._conn = None
+
+class ConnectionPool:
+    """Keeps up to `size` idle connections so page cache, statement cache and pragmas survive between requests"""
+    def __init__(self, path: str, size: int):
+        self.path = path
+        self._idle = queue.LifoQueue(maxsize=size)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=256)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.execute("PRAGMA cache_size=-8000")  # 8 MB per connection
+        conn.execute("PRAGMA mmap_size=268435456")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+
+    def acquire(self) -> PooledConnection:
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+        return PooledConnection(conn, self)
+
+    def release(self, conn: sqlite3.Connection):
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close_all(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+_db_pool = None
+
+def get_db() -> PooledConnection:
+    global _db_pool
+    if _db_pool is None:
+        _db_pool = ConnectionPool(DATABASE_PATH, DB_POOL_SIZE)
+    return _db_pool.acquire()
+
+async def read_one(sql: str, params=()) -> Optional[sqlite3.Row]:
+    """Single-row read for async endpoints, on a thread so a busy database can't stall the event loop"""
+    def read():
+        conn = get_db()
+        try:
+            return conn.execute(sql, params).fetchone()
+        finally:
+            conn.close()
+    return await asyncio.to_thread(read)
+
+class DBWriter:
+    """Request-path writes go through one thread that owns a write connection. A unit of work is
+    fn(conn) doing all of one request's writes, without committing; whatever queued up while the
+    previous COMMIT ran goes into the next transaction (group commit), each unit under its own
+    SAVEPOINT so a failing unit is rolled back alone and its exception re-raised to its caller.
+    Job claims are units too: the writer's BEGIN IMMEDIATE makes claim_job's read-then-update atomic."""
+    def __init__(self, max_batch: int):
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, fn) -> concurrent.futures.Future:
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+                self._thread.start()
+        future = concurrent.futures.Future()
+        self._queue.put((fn, future))
+        return future
+
+    def run(self, fn):
+        """Apply fn(conn) in the next group commit; returns its result once committed"""
+        return self.submit(fn).result()
+
+    async def run_async(self, fn):
+        return await asyncio.wrap_future(self.submit(fn))
+
+    def stop(self):
+        with self._lock:
+            if self._thread is None:
+                return
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        conn = get_db()
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    return
+                batch = [item]
+                while len(batch) < self.max_batch:
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        self._queue.put(None)  # stop once this batch is committed
+                        break
+                    batch.append(item)
+                self._apply(conn, batch)
+        finally:
+            conn.close()
+
+    def _apply(self, conn, batch: list):
+        # a caller that gave up (e.g. a cancelled run_async) has cancelled its future; skip its unit
+        batch = [(fn, future) for fn, future in batch if future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        outcomes = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for fn, future in batch:
+                conn.execute("SAVEPOINT unit")
+                try:
+                    outcomes.append((future, fn(conn), None))
+                    conn.execute("RELEASE unit")
+                except Exception as e:
+                    conn.execute("ROLLBACK TO unit")
+                    conn.execute("RELEASE unit")
+                    outcomes.append((future, None, e))
+            conn.commit()
+        except Exception as e:
+            if conn.in_transaction:
+                conn.rollback()
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for future, result, error in outcomes:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+db_writer = DBWriter(DB_WRITE_BATCH)
 
 def init_db():
     conn = get_db()
@@ -124,18 +324,435 @@ def init_db():
         );
     """)
     conn.commit()
+    run_migrations(conn)
     conn.close()
 
+# ---------- MIGRATIONS ----------
+MIGRATION_LOCK_TIMEOUT_MS = 600000  # how long a worker waits for another worker's migration
+
+def run_migrations(conn):
+    """Apply every MIGRATIONS entry newer than the database's PRAGMA user_version, in order.
+    Each migration and its user_version bump are one BEGIN IMMEDIATE transaction, and the version is
+    re-read under that lock, so workers starting together apply each migration exactly once and a
+    crash part-way leaves the previous version in place. Migrations therefore must not commit.
+    A migration's `before_transaction` step (e.g. a VACUUM, which can't run in a transaction) runs
+    first, outside the lock; it must be idempotent, and the migration itself then runs even if
+    another worker already applied it, so that it follows this worker's step."""
+    busy_timeout = conn.execute("PRAGMA busy_timeout").fetchone()[0]
+    conn.execute(f"PRAGMA busy_timeout = {MIGRATION_LOCK_TIMEOUT_MS}")
+    try:
+        for target, migration in enumerate(MIGRATIONS, start=1):
+            if target <= conn.execute("PRAGMA user_version").fetchone()[0]:
+                continue
+            before = getattr(migration, "before_transaction", None)
+            stepped = before(conn) if before else False
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                version = conn.execute("PRAGMA user_version").fetchone()[0]
+                if target <= version and not stepped:
+                    conn.rollback()
+                    continue
+                if callable(migration):
+                    migration(conn)
+                else:
+                    execute_statements(conn, migration)
+                if target > version:
+                    conn.execute(f"PRAGMA user_version = {target}")
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            print(f"Applied database migration {target}")
+    finally:
+        conn.execute(f"PRAGMA busy_timeout = {busy_timeout}")
+
+def execute_statements(conn, script: str):
+    """executescript() without its implicit COMMIT, so a script can run inside the caller's transaction"""
+    statement = ""
+    for piece in script.split(";"):
+        statement += piece + ";"
+        if sqlite3.complete_statement(statement):
+            conn.execute(statement)
+            statement = ""
+
+def migrate_inline_images(conn):
+    """Move base64 data: URLs out of generations.image_url into the image store"""
+    ids = [r[0] for r in conn.execute("SELECT id FROM generations WHERE image_url LIKE 'data:%'").fetchall()]
+    for gen_id in ids:
+        data_url = conn.execute("SELECT image_url FROM generations WHERE id = ?", (gen_id,)).fetchone()[0]
+        try:
+            image_bytes = base64.b64decode(data_url.split(",", 1)[1])
+        except (IndexError, binascii.Error):
+            print(f"Skipping unreadable inline image on generation {gen_id}")
+            continue
+        conn.execute("UPDATE generations SET image_url = ? WHERE id = ?", (store_image(image_bytes), gen_id))
+    # the space the data: URLs took is reclaimed by migration 9's VACUUM
+
+def reindex_generations_fts(conn):
+    """Re-index generations_fts the way migration 4 backfills it (user_id with hyphens stripped);
+    FTS5's own 'rebuild' would index the raw user_id that build_search_query never matches"""
+    conn.execute("INSERT INTO generations_fts(generations_fts) VALUES ('delete-all')")
+    conn.execute("""
+        INSERT INTO generations_fts(rowid, user_id, topic, script, visual_prompt)
+        SELECT rowid, replace(user_id, '-', ''), topic, script, visual_prompt FROM generations
+    """)
+
+def vacuum_to_incremental(conn) -> bool:
+    """Switch to auto_vacuum=INCREMENTAL so analytics compaction can return freed pages to the OS.
+    The switch takes one full VACUUM; returns whether this call ran it"""
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        return False
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
+    return True
+
+def enable_incremental_vacuum(conn):
+    """The VACUUM may renumber generations rowids, so the FTS index is rebuilt after it"""
+    reindex_generations_fts(conn)
+
+enable_incremental_vacuum.before_transaction = vacuum_to_incremental
+
+# Per-user generation counts for /analytics, maintained by triggers on every insert/delete:
+# one row per user per day (timeline) and one per user per platform/brand/tone (all-time totals).
+GENERATION_ROLLUP_SCHEMA = """
+CREATE TABLE IF NOT EXISTS generation_rollup_daily (
+    user_id TEXT NOT NULL,
+    day TEXT NOT NULL,
+    generations INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, day)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS generation_rollup_totals (
+    user_id TEXT NOT NULL,
+    dimension TEXT NOT NULL,  -- 'platform', 'brand' or 'tone'
+    value TEXT NOT NULL,
+    generations INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, dimension, value)
+) WITHOUT ROWID;
+CREATE TRIGGER IF NOT EXISTS generations_rollup_ai AFTER INSERT ON generations BEGIN
+    INSERT INTO generation_rollup_daily (user_id, day, generations) VALUES (new.user_id, date(new.created_at), 1)
+        ON CONFLICT (user_id, day) DO UPDATE SET generations = generations + 1;
+    INSERT INTO generation_rollup_totals (user_id, dimension, value, generations) VALUES
+        (new.user_id, 'platform', coalesce(new.platform, ''), 1),
+        (new.user_id, 'brand', coalesce(new.brand_name, ''), 1),
+        (new.user_id, 'tone', coalesce(new.tone, ''), 1)
+        ON CONFLICT (user_id, dimension, value) DO UPDATE SET generations = generations + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS generations_rollup_ad AFTER DELETE ON generations BEGIN
+    UPDATE generation_rollup_daily SET generations = generations - 1 WHERE user_id = old.user_id AND day = date(old.created_at);
+    UPDATE generation_rollup_totals SET generations = generations - 1 WHERE user_id = old.user_id AND dimension = 'platform' AND value = coalesce(old.platform, '');
+    UPDATE generation_rollup_totals SET generations = generations - 1 WHERE user_id = old.user_id AND dimension = 'brand' AND value = coalesce(old.brand_name, '');
+    UPDATE generation_rollup_totals SET generations = generations - 1 WHERE user_id = old.user_id AND dimension = 'tone' AND value = coalesce(old.tone, '');
+    DELETE FROM generation_rollup_daily WHERE user_id = old.user_id AND day = date(old.created_at) AND generations <= 0;
+    DELETE FROM generation_rollup_totals WHERE user_id = old.user_id AND generations <= 0;
+END;
+CREATE TRIGGER IF NOT EXISTS generations_rollup_au AFTER UPDATE OF user_id, platform, brand_name, tone, created_at ON generations BEGIN
+    UPDATE generation_rollup_daily SET generations = generations - 1 WHERE user_id = old.user_id AND day = date(old.created_at);
+    UPDATE generation_rollup_totals SET generations = generations - 1 WHERE user_id = old.user_id AND dimension = 'platform' AND value = coalesce(old.platform, '');
+    UPDATE generation_rollup_totals SET generations = generations - 1 WHERE user_id = old.user_id AND dimension = 'brand' AND value = coalesce(old.brand_name, '');
+    UPDATE generation_rollup_totals SET generations = generations - 1 WHERE user_id = old.user_id AND dimension = 'tone' AND value = coalesce(old.tone, '');
+    DELETE FROM generation_rollup_daily WHERE user_id = old.user_id AND generations <= 0;
+    DELETE FROM generation_rollup_totals WHERE user_id = old.user_id AND generations <= 0;
+    INSERT INTO generation_rollup_daily (user_id, day, generations) VALUES (new.user_id, date(new.created_at), 1)
+        ON CONFLICT (user_id, day) DO UPDATE SET generations = generations + 1;
+    INSERT INTO generation_rollup_totals (user_id, dimension, value, generations) VALUES
+        (new.user_id, 'platform', coalesce(new.platform, ''), 1),
+        (new.user_id, 'brand', coalesce(new.brand_name, ''), 1),
+        (new.user_id, 'tone', coalesce(new.tone, ''), 1)
+        ON CONFLICT (user_id, dimension, value) DO UPDATE SET generations = generations + 1;
+END;
+"""
+
+# Distinct platforms follow the platform rows of generation_rollup_totals, which exist while count > 0.
+# Generations without a platform roll up under '', which is not a platform.
+PLATFORM_COUNTER_TRIGGERS = """
+CREATE TRIGGER IF NOT EXISTS platform_counter_ai AFTER INSERT ON generation_rollup_totals
+WHEN new.dimension = 'platform' AND new.value != '' BEGIN
+    UPDATE users SET platform_count = platform_count + 1 WHERE id = new.user_id;
+END;
+CREATE TRIGGER IF NOT EXISTS platform_counter_ad AFTER DELETE ON generation_rollup_totals
+WHEN old.dimension = 'platform' AND old.value != '' BEGIN
+    UPDATE users SET platform_count = platform_count - 1 WHERE id = old.user_id;
+END;
+"""
+
+# Gamification counters on users, kept in step by triggers so /gamification is a single-row read.
+GAMIFICATION_COUNTER_SCHEMA = """
+ALTER TABLE users ADD COLUMN generation_count INTEGER DEFAULT 0;
+ALTER TABLE users ADD COLUMN brand_count INTEGER DEFAULT 0;
+ALTER TABLE users ADD COLUMN campaign_count INTEGER DEFAULT 0;
+ALTER TABLE users ADD COLUMN platform_count INTEGER DEFAULT 0;
+ALTER TABLE users ADD COLUMN badges_unseen TEXT DEFAULT '[]';
+CREATE TRIGGER IF NOT EXISTS generations_counter_ai AFTER INSERT ON generations BEGIN
+    UPDATE users SET generation_count = generation_count + 1 WHERE id = new.user_id;
+END;
+CREATE TRIGGER IF NOT EXISTS generations_counter_ad AFTER DELETE ON generations BEGIN
+    UPDATE users SET generation_count = generation_count - 1 WHERE id = old.user_id;
+END;
+CREATE TRIGGER IF NOT EXISTS generations_counter_au AFTER UPDATE OF user_id ON generations WHEN old.user_id IS NOT new.user_id BEGIN
+    UPDATE users SET generation_count = generation_count - 1 WHERE id = old.user_id;
+    UPDATE users SET generation_count = generation_count + 1 WHERE id = new.user_id;
+END;
+CREATE TRIGGER IF NOT EXISTS brands_counter_ai AFTER INSERT ON brands BEGIN
+    UPDATE users SET brand_count = brand_count + 1 WHERE id = new.user_id;
+END;
+CREATE TRIGGER IF NOT EXISTS brands_counter_ad AFTER DELETE ON brands BEGIN
+    UPDATE users SET brand_count = brand_count - 1 WHERE id = old.user_id;
+END;
+CREATE TRIGGER IF NOT EXISTS campaigns_counter_ai AFTER INSERT ON campaigns BEGIN
+    UPDATE users SET campaign_count = campaign_count + 1 WHERE id = new.user_id;
+END;
+CREATE TRIGGER IF NOT EXISTS campaigns_counter_ad AFTER DELETE ON campaigns BEGIN
+    UPDATE users SET campaign_count = campaign_count - 1 WHERE id = old.user_id;
+END;
+""" + PLATFORM_COUNTER_TRIGGERS
+
+def migrate_gamification_counters(conn):
+    """Add the counters, backfill them and award any badges users already qualify for"""
+    execute_statements(conn, GAMIFICATION_COUNTER_SCHEMA)
+    for (user_id,) in conn.execute("SELECT id FROM users").fetchall():
+        recount_gamification_counters(conn, user_id)
+
+def migrate_platform_counters(conn):
+    """Stop counting '' as a platform: recreate the platform triggers and recount"""
+    execute_statements(conn, "DROP TRIGGER IF EXISTS platform_counter_ai; DROP TRIGGER IF EXISTS platform_counter_ad;"
+                       + PLATFORM_COUNTER_TRIGGERS)
+    for (user_id,) in conn.execute("SELECT id FROM users").fetchall():
+        recount_gamification_counters(conn, user_id)
+
+# users.data_version keys the response cache (see cached_user_response). Triggers bump it in the same
+# transaction as any write to data the cached responses show, whichever worker or job makes it.
+USER_DATA_VERSION_SCHEMA = "ALTER TABLE users ADD COLUMN data_version INTEGER DEFAULT 0;" + "".join(f"""
+CREATE TRIGGER IF NOT EXISTS {table}_version_ai AFTER INSERT ON {table} BEGIN
+    UPDATE users SET data_version = data_version + 1 WHERE id = new.user_id;
+END;
+CREATE TRIGGER IF NOT EXISTS {table}_version_au AFTER UPDATE ON {table} BEGIN
+    UPDATE users SET data_version = data_version + 1 WHERE id IN (old.user_id, new.user_id);
+END;
+CREATE TRIGGER IF NOT EXISTS {table}_version_ad AFTER DELETE ON {table} BEGIN
+    UPDATE users SET data_version = data_version + 1 WHERE id = old.user_id;
+END;""" for table in ("generations", "brands", "campaigns", "approvals")) + """
+CREATE TRIGGER IF NOT EXISTS users_version_au
+AFTER UPDATE OF xp, level, badges, streak_current, streak_best, generation_count, badges_unseen ON users BEGIN
+    UPDATE users SET data_version = data_version + 1 WHERE id = new.id;
+END;
+"""
+
+# Recompute the rollups from scratch (backfill, or repair after editing generations with triggers off)
+GENERATION_ROLLUP_REBUILD = """
+DELETE FROM generation_rollup_daily;
+DELETE FROM generation_rollup_totals;
+INSERT INTO generation_rollup_daily (user_id, day, generations)
+    SELECT user_id, date(created_at), COUNT(*) FROM generations GROUP BY user_id, date(created_at);
+INSERT INTO generation_rollup_totals (user_id, dimension, value, generations)
+    SELECT user_id, 'platform', coalesce(platform, ''), COUNT(*) FROM generations GROUP BY 1, 3
+    UNION ALL SELECT user_id, 'brand', coalesce(brand_name, ''), COUNT(*) FROM generations GROUP BY 1, 3
+    UNION ALL SELECT user_id, 'tone', coalesce(tone, ''), COUNT(*) FROM generations GROUP BY 1, 3;
+"""
+
+# Append-only: position in the list is the schema version
+MIGRATIONS = [
+    # 1
+    migrate_inline_images,
+    # 2: indexes matching the WHERE / ORDER BY shapes of the hot queries
+    """
+    CREATE INDEX IF NOT EXISTS idx_generations_user_created ON generations(user_id, created_at);
+    CREATE INDEX IF NOT EXISTS idx_generations_user_scheduled ON generations(user_id, scheduled_date);
+    CREATE INDEX IF NOT EXISTS idx_generations_user_evergreen ON generations(user_id, created_at) WHERE is_evergreen = 1;
+    CREATE INDEX IF NOT EXISTS idx_analytics_user_created ON analytics(user_id, created_at);
+    CREATE INDEX IF NOT EXISTS idx_brands_user_created ON brands(user_id, created_at);
+    CREATE INDEX IF NOT EXISTS idx_campaigns_user_created ON campaigns(user_id, created_at);
+    CREATE INDEX IF NOT EXISTS idx_approvals_user_created ON approvals(user_id, created_at);
+    CREATE INDEX IF NOT EXISTS idx_approvals_generation ON approvals(generation_id);
+    """,
+    # 3: id tie-breaker so /history keyset pages never need a sort
+    """
+    DROP INDEX IF EXISTS idx_generations_user_created;
+    CREATE INDEX IF NOT EXISTS idx_generations_user_created_id ON generations(user_id, created_at, id);
+    """,
+    # 4: full-text index over generated content, kept in sync by triggers. It is external-content
+    # on generations.rowid and indexes user_id with hyphens stripped, so each tenant is a single
+    # token. Re-index with the backfill INSERT below, not 'rebuild', and after any full VACUUM.
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS generations_fts USING fts5(
+        user_id, topic, script, visual_prompt,
+        content='generations', content_rowid='rowid'
+    );
+    CREATE TRIGGER IF NOT EXISTS generations_fts_ai AFTER INSERT ON generations BEGIN
+        INSERT INTO generations_fts(rowid, user_id, topic, script, visual_prompt)
+        VALUES (new.rowid, replace(new.user_id, '-', ''), new.topic, new.script, new.visual_prompt);
+    END;
+    CREATE TRIGGER IF NOT EXISTS generations_fts_ad AFTER DELETE ON generations BEGIN
+        INSERT INTO generations_fts(generations_fts, rowid, user_id, topic, script, visual_prompt)
+        VALUES ('delete', old.rowid, replace(old.user_id, '-', ''), old.topic, old.script, old.visual_prompt);
+    END;
+    CREATE TRIGGER IF NOT EXISTS generations_fts_au AFTER UPDATE OF user_id, topic, script, visual_prompt ON generations BEGIN
+        INSERT INTO generations_fts(generations_fts, rowid, user_id, topic, script, visual_prompt)
+        VALUES ('delete', old.rowid, replace(old.user_id, '-', ''), old.topic, old.script, old.visual_prompt);
+        INSERT INTO generations_fts(rowid, user_id, topic, script, visual_prompt)
+        VALUES (new.rowid, replace(new.user_id, '-', ''), new.topic, new.script, new.visual_prompt);
+    END;
+    INSERT INTO generations_fts(rowid, user_id, topic, script, visual_prompt)
+    SELECT rowid, replace(user_id, '-', ''), topic, script, visual_prompt FROM generations;
+    """,
+    # 5: background generation jobs
+    """
+    CREATE TABLE IF NOT EXISTS jobs (
+        id TEXT PRIMARY KEY,
+        user_id TEXT NOT NULL,
+        kind TEXT NOT NULL DEFAULT 'generate',
+        status TEXT NOT NULL DEFAULT 'queued',
+        stage TEXT DEFAULT 'queued',
+        request TEXT NOT NULL,
+        result TEXT DEFAULT '',
+        error TEXT DEFAULT '',
+        attempts INTEGER DEFAULT 0,
+        lease_until REAL DEFAULT 0,
+        created_at TEXT DEFAULT (datetime('now')),
+        updated_at TEXT DEFAULT (datetime('now')),
+        FOREIGN KEY (user_id) REFERENCES users(id)
+    );
+    CREATE INDEX IF NOT EXISTS idx_jobs_status_created ON jobs(status, created_at);
+    """,
+    # 6: group the jobs of one bulk request (e.g. a campaign's posts)
+    """
+    ALTER TABLE jobs ADD COLUMN batch_id TEXT DEFAULT '';
+    CREATE INDEX IF NOT EXISTS idx_jobs_batch ON jobs(batch_id);
+    """,
+    # 7: incremental /analytics rollups, backfilled from existing generations
+    GENERATION_ROLLUP_SCHEMA + GENERATION_ROLLUP_REBUILD,
+    # 8: downsampled analytics events (see compact_analytics); bucket first so old buckets are a range scan
+    """
+    CREATE TABLE IF NOT EXISTS analytics_hourly (
+        hour TEXT NOT NULL,
+        user_id TEXT NOT NULL,
+        action TEXT NOT NULL,
+        events INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (hour, user_id, action)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS analytics_daily (
+        day TEXT NOT NULL,
+        user_id TEXT NOT NULL,
+        action TEXT NOT NULL,
+        events INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, user_id, action)
+    ) WITHOUT ROWID;
+    """,
+    # 9
+    enable_incremental_vacuum,
+    # 10
+    migrate_gamification_counters,
+    # 11: repair FTS indexes that an earlier migration 9 rebuilt with hyphenated user_ids
+    reindex_generations_fts,
+    # 12: per-user job counts and queue heads for claim_job's fair ordering
+    """
+    CREATE INDEX IF NOT EXISTS idx_jobs_status_user ON jobs(status, user_id, created_at);
+    """,
+    # 13: response cache versions shared by every worker
+    USER_DATA_VERSION_SCHEMA,
+    # 14
+    migrate_platform_counters,
+    # 15: a batch's jobs in creation order (rowid breaks ties) without a sort
+    """
+    DROP INDEX IF EXISTS idx_jobs_batch;
+    CREATE INDEX IF NOT EXISTS idx_jobs_batch_created ON jobs(batch_id, created_at);
+    """,
+    # 16: unix time a deferred image fetch has until; 0 once it has landed or failed
+    """
+    ALTER TABLE generations ADD COLUMN image_deadline REAL DEFAULT 0;
+    """,
+]
+
+# ---------- IMAGE STORE ----------
+IMAGE_HASH_RE = re.compile(r"[0-9a-f]{64}")
+
+def image_path(image_hash: str) -> str:
+    return os.path.join(IMAGE_STORE_DIR, image_hash[:2], image_hash)
+
+def store_image(image_bytes: bytes) -> str:
+    """Write image bytes once under their SHA-256 and return the /images reference stored in rows"""
+    image_hash = hashlib.sha256(image_bytes).hexdigest()
+    path = image_path(image_hash)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{secrets.token_hex(4)}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(image_bytes)
+        os.replace(tmp_path, path)
+    return f"/images/{image_hash}"
+
+def sniff_image_type(head: bytes) -> str:
+    if head.startswith(b"\x89PNG"):
+        return "image/png"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head.startswith(b"GIF8"):
+        return "image/gif"
+    return "image/jpeg"
+
 # ---------- AUTH HELPERS ----------
-def hash_password(password: str) -> str:
+# Password hashing runs in its own small process pool: a burst of logins then queues there
+# instead of filling the threadpool every sync endpoint shares.
+_password_pool = None
+_password_jobs = 0  # hashes running or waiting; only touched on the event loop
+# Pools in a row that broke before hashing anything. A pool that keeps breaking (e.g. the host
+# script has no __main__ guard) would be respawned on every sign-in, so after this many hashing
+# stays on threads until the process restarts.
+_password_pool_breaks = 0
+PASSWORD_POOL_MAX_BREAKS = 3
+
+async def pbkdf2(password: str, salt: str, iterations: int) -> str:
+    global _password_pool, _password_jobs, _password_pool_breaks
+    if _password_jobs >= PASSWORD_WORKERS + PASSWORD_QUEUE:
+        raise HTTPException(status_code=503, detail="Too many sign-ins right now, please retry shortly",
+                            headers={"Retry-After": "2"})
+    if _password_pool is None and _password_pool_breaks < PASSWORD_POOL_MAX_BREAKS:
+        # spawn: forking a process that already runs threads and an event loop is unsafe
+        _password_pool = ProcessPoolExecutor(max_workers=PASSWORD_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    pool = _password_pool
+    _password_jobs += 1
+    args = ('sha256', password.encode(), salt.encode(), iterations)
+    try:
+        if pool is None:
+            hashed = await asyncio.to_thread(hashlib.pbkdf2_hmac, *args)
+        else:
+            hashed = await asyncio.get_running_loop().run_in_executor(pool, hashlib.pbkdf2_hmac, *args)
+            _password_pool_breaks = 0
+    except concurrent.futures.process.BrokenProcessPool:
+        # A worker died (OOM kill, or a host script without a __main__ guard) and a broken pool
+        # never recovers. The first caller to notice shuts it down so the next call spawns a
+        # fresh one; this hash goes to a thread either way.
+        if _password_pool is pool:
+            pool.shutdown(wait=False, cancel_futures=True)
+            _password_pool = None
+            _password_pool_breaks += 1
+            if _password_pool_breaks >= PASSWORD_POOL_MAX_BREAKS:
+                print(f"Password pool broke {_password_pool_breaks} times in a row; hashing on threads from now on")
+            else:
+                print("Password pool broken; recreating it")
+        hashed = await asyncio.to_thread(hashlib.pbkdf2_hmac, *args)
+    finally:
+        _password_jobs -= 1
+    return hashed.hex()
+
+async def hash_password(password: str) -> str:
     salt = secrets.token_hex(16)
-    hashed = hashlib.pbkdf2_hmac('sha256', password.encode(), salt.encode(), 100000)
-    return f"{salt}:{hashed.hex()}"
+    return f"pbkdf2_sha256${PASSWORD_ITERATIONS}${salt}${await pbkdf2(password, salt, PASSWORD_ITERATIONS)}"
 
-def verify_password(password: str, stored: str) -> bool:
+def parse_password_hash(stored: str):
+    """-> (iterations, salt, hex digest); bare "salt:digest" hashes predate the prefix and used 100k iterations"""
+    if stored.startswith("pbkdf2_sha256$"):
+        _, iterations, salt, hashed = stored.split('$')
+        return int(iterations), salt, hashed
     salt, hashed = stored.split(':')
-    check = hashlib.pbkdf2_hmac('sha256', password.encode(), salt.encode(), 100000)
-    return check.hex() == hashed
+    return 100000, salt, hashed
+
+async def verify_password(password: str, stored: str) -> bool:
+    import hmac
+    iterations, salt, hashed = parse_password_hash(stored)
+    return hmac.compare_digest(await pbkdf2(password, salt, iterations), hashed)
+
+def password_needs_rehash(stored: str) -> bool:
+    return not stored.startswith(f"pbkdf2_sha256${PASSWORD_ITERATIONS}$")
 
 def create_token(user_id: str, username: str) -> str:
     import hmac
@@ -148,19 +765,36 @@ def create_token(user_id: str, username: str) -> str:
     signature = hmac.new(JWT_SECRET.encode(), payload_b64.encode(), hashlib.sha256).hexdigest()
     return f"{payload_b64}.{signature}"
 
+# token -> (payload, expiry as a time.time() value); LRU, only ever holds tokens that verified
+_verified_tokens = OrderedDict()
+_verified_tokens_lock = threading.Lock()
+
 def decode_token(token: str) -> dict:
     import hmac
+    with _verified_tokens_lock:
+        cached = _verified_tokens.get(token)
+        if cached is not None:
+            if cached[1] > time.time():
+                _verified_tokens.move_to_end(token)
+                return dict(cached[0])
+            del _verified_tokens[token]
     try:
         payload_b64, signature = token.rsplit('.', 1)
         expected = hmac.new(JWT_SECRET.encode(), payload_b64.encode(), hashlib.sha256).hexdigest()
         if not hmac.compare_digest(signature, expected):
             raise ValueError("Invalid signature")
         payload = json.loads(base64.urlsafe_b64decode(payload_b64))
-        if datetime.fromisoformat(payload["exp"]) < datetime.utcnow():
+        ttl = (datetime.fromisoformat(payload["exp"]) - datetime.utcnow()).total_seconds()
+        if ttl < 0:
             raise ValueError("Token expired")
-        return payload
     except Exception:
         raise HTTPException(status_code=401, detail="Invalid or expired token")
+    if TOKEN_CACHE_SIZE > 0:
+        with _verified_tokens_lock:
+            _verified_tokens[token] = (payload, time.time() + ttl)
+            if len(_verified_tokens) > TOKEN_CACHE_SIZE:
+                _verified_tokens.popitem(last=False)
+    return dict(payload)
 
 security = HTTPBearer(auto_error=False)
 
@@ -178,16 +812,93 @@ def get_optional_user(credentials: HTTPAuthorizationCredentials = Depends(securi
         return None
 
 # ---------- RATE LIMITER ----------
-rate_limit_store = {}
+# GCRA: each key stores one "theoretical arrival time" (TAT). A call advances it by
+# window/max_calls and is allowed while it stays within `window` of now, which permits
+# bursts of up to max_calls and then one call per window/max_calls. A key whose TAT is
+# in the past is indistinguishable from a new one, so it can be dropped.
+class MemoryRateLimiter:
+    """Per-process GCRA state; keys are kept in update order so idle ones are evicted from the front"""
+    blocking = False
+
+    def __init__(self):
+        self._tats = OrderedDict()
+        self._lock = threading.Lock()
+
+    def hit(self, key: str, max_calls: int, window_seconds: float) -> float:
+        """Record a call; returns 0 if allowed, else seconds until the next call would be"""
+        now = time.time()
+        with self._lock:
+            while self._tats:
+                oldest = next(iter(self._tats.values()))
+                if oldest > now:
+                    break
+                self._tats.popitem(last=False)
+            tat = max(self._tats.get(key, now), now) + window_seconds / max_calls
+            if tat - now > window_seconds:
+                return tat - now - window_seconds
+            self._tats[key] = tat
+            self._tats.move_to_end(key)
+            return 0.0
+
+    def __len__(self):
+        return len(self._tats)
+
+class SQLiteRateLimiter:
+    """GCRA state in a small SQLite file, so every worker process on the host enforces the same limits.
+    Each check is a single atomic upsert, but it can wait up to busy_timeout for another worker's."""
+    SWEEP_EVERY = 1000  # calls between deletes of expired keys
+    blocking = True
+
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=OFF")  # losing the last few hits in a crash is harmless
+        self._conn.execute("PRAGMA busy_timeout=1000")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS rate_limits (key TEXT PRIMARY KEY, tat REAL NOT NULL) WITHOUT ROWID")
+        self._lock = threading.Lock()
+        self._calls = 0
+
+    def hit(self, key: str, max_calls: int, window_seconds: float) -> float:
+        now = time.time()
+        interval = window_seconds / max_calls
+        with self._lock:
+            self._calls += 1
+            if self._calls % self.SWEEP_EVERY == 0:
+                self._conn.execute("DELETE FROM rate_limits WHERE tat <= ?", (now,))
+            row = self._conn.execute(
+                """INSERT INTO rate_limits (key, tat) VALUES (?1, ?2 + ?3)
+                   ON CONFLICT(key) DO UPDATE SET tat = max(tat, ?2) + ?3 WHERE max(tat, ?2) + ?3 - ?2 <= ?4
+                   RETURNING tat""",
+                (key, now, interval, window_seconds)
+            ).fetchone()
+            if row is not None:
+                return 0.0
+            (tat,) = self._conn.execute("SELECT tat FROM rate_limits WHERE key = ?", (key,)).fetchone()
+            return max(tat, now) + interval - now - window_seconds
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT count(*) FROM rate_limits").fetchone()[0]
+
+rate_limiter = SQLiteRateLimiter(RATE_LIMIT_DB) if RATE_LIMIT_BACKEND == "sqlite" else MemoryRateLimiter()
 
 def check_rate_limit(key: str, max_calls: int = 30, window_seconds: int = 60):
-    now = datetime.utcnow()
-    if key not in rate_limit_store:
-        rate_limit_store[key] = []
-    rate_limit_store[key] = [t for t in rate_limit_store[key] if (now - t).total_seconds() < window_seconds]
-    if len(rate_limit_store[key]) >= max_calls:
-        raise HTTPException(status_code=429, detail="Rate limit exceeded. Try again shortly.")
-    rate_limit_store[key].append(now)
+    """Each (key, limit) pair is its own bucket, so e.g. /generate-image has its own 10/min next to /generate's 20/min.
+    For sync endpoints; async ones use check_rate_limit_async."""
+    raise_if_rate_limited(rate_limiter.hit(f"{key}:{max_calls}/{window_seconds}", max_calls, window_seconds))
+
+async def check_rate_limit_async(key: str, max_calls: int = 30, window_seconds: int = 60):
+    """check_rate_limit without blocking the event loop: a limiter that can wait on a lock is asked on a thread"""
+    args = (f"{key}:{max_calls}/{window_seconds}", max_calls, window_seconds)
+    if rate_limiter.blocking:
+        raise_if_rate_limited(await asyncio.to_thread(rate_limiter.hit, *args))
+    else:
+        raise_if_rate_limited(rate_limiter.hit(*args))
+
+def raise_if_rate_limited(retry_after: float):
+    if retry_after:
+        raise HTTPException(status_code=429, detail="Rate limit exceeded. Try again shortly.",
+                            headers={"Retry-After": str(max(1, round(retry_after)))})
 
 # ---------- DATA MODELS ----------
 class UserRegister(BaseModel):
@@ -212,6 +923,7 @@ class GenerateRequest(BaseModel):
     text_structure: Optional[str] = "Short Caption"
     level: int = 1
     variations: int = 1  # A/B mode: 1-3
+    fresh: bool = False  # skip the generation cache
 
 class ImageGenerateRequest(BaseModel):
     prompt: str
@@ -247,71 +959,89 @@ app.add_middleware(
 def startup():
     init_db()
 
+@app.on_event("shutdown")
+async def shutdown():
+    global _pollinations_client
+    await stop_job_workers()
+    await stop_analytics_compactor()
+    if _pollinations_client is not None:
+        await _pollinations_client.aclose()
+        _pollinations_client = None
+    if _password_pool is not None:
+        _password_pool.shutdown(wait=False, cancel_futures=True)
+    db_writer.stop()
+    if _db_pool is not None:
+        _db_pool.close_all()
+
 # ---------- AUTH ----------
 @app.post("/register")
-def register(user: UserRegister):
-    conn = get_db()
-    try:
-        existing = conn.execute("SELECT id FROM users WHERE email = ?", (user.email,)).fetchone()
-        if existing:
+async def register(user: UserRegister):
+    # No connection is held while the password hashes
+    existing = await read_one("SELECT id FROM users WHERE email = ?", (user.email,))
+    if existing:
+        raise HTTPException(status_code=400, detail="Email already registered")
+    password_hash = await hash_password(user.password)
+    user_id = str(uuid.uuid4())
+
+    def write(conn):
+        try:
+            conn.execute(
+                "INSERT INTO users (id, username, email, password_hash) VALUES (?, ?, ?, ?)",
+                (user_id, user.username, user.email, password_hash)
+            )
+        except sqlite3.IntegrityError:
             raise HTTPException(status_code=400, detail="Email already registered")
-        user_id = str(uuid.uuid4())
-        conn.execute(
-            "INSERT INTO users (id, username, email, password_hash) VALUES (?, ?, ?, ?)",
-            (user_id, user.username, user.email, hash_password(user.password))
-        )
-        conn.commit()
         # Track analytics
         conn.execute("INSERT INTO analytics (user_id, action, metadata) VALUES (?, ?, ?)",
                       (user_id, "register", "{}"))
-        conn.commit()
-        return {"message": "Registration successful", "user": user.username}
-    finally:
-        conn.close()
+    await db_writer.run_async(write)
+    return {"message": "Registration successful", "user": user.username}
 
 @app.post("/login")
-def login(user: UserLogin):
-    conn = get_db()
-    try:
-        row = conn.execute("SELECT * FROM users WHERE email = ?", (user.email,)).fetchone()
-        if not row or not verify_password(user.password, row["password_hash"]):
-            raise HTTPException(status_code=401, detail="Invalid credentials")
-        token = create_token(row["id"], row["username"])
+async def login(user: UserLogin):
+    row = await read_one("SELECT * FROM users WHERE email = ?", (user.email,))
+    if not row or not await verify_password(user.password, row["password_hash"]):
+        raise HTTPException(status_code=401, detail="Invalid credentials")
+    # Hashes made under an older PASSWORD_ITERATIONS (or the old format) upgrade on the next login
+    new_hash = await hash_password(user.password) if password_needs_rehash(row["password_hash"]) else None
+    token = create_token(row["id"], row["username"])
+
+    def write(conn):
+        if new_hash:
+            conn.execute("UPDATE users SET password_hash = ? WHERE id = ?", (new_hash, row["id"]))
         # Track analytics
         conn.execute("INSERT INTO analytics (user_id, action) VALUES (?, ?)", (row["id"], "login"))
-        conn.commit()
-        return {"access_token": token, "token_type": "bearer", "username": row["username"]}
-    finally:
-        conn.close()
+    await db_writer.run_async(write)
+    return {"access_token": token, "token_type": "bearer", "username": row["username"]}
 
 # ---------- BRAND PROFILES ----------
 @app.get("/brands")
-def list_brands(user=Depends(get_current_user)):
-    conn = get_db()
-    try:
-        rows = conn.execute("SELECT * FROM brands WHERE user_id = ? ORDER BY created_at DESC", (user["user_id"],)).fetchall()
-        return [dict(r) for r in rows]
-    finally:
-        conn.close()
+def list_brands(request: Request, user=Depends(get_current_user)):
+    def build():
+        conn = get_db()
+        try:
+            rows = conn.execute("SELECT * FROM brands WHERE user_id = ? ORDER BY created_at DESC", (user["user_id"],)).fetchall()
+            return [dict(r) for r in rows]
+        finally:
+            conn.close()
+    return cached_user_response(request, user["user_id"], build)
 
 @app.post("/brands")
 def create_brand(brand: BrandCreate, user=Depends(get_current_user)):
-    conn = get_db()
-    try:
-        brand_id = str(uuid.uuid4())
+    brand_id = str(uuid.uuid4())
+
+    def write(conn):
         conn.execute(
             "INSERT INTO brands (id, user_id, name, industry, default_tone, default_audience, default_platform, color_palette) VALUES (?,?,?,?,?,?,?,?)",
             (brand_id, user["user_id"], brand.name, brand.industry, brand.default_tone, brand.default_audience, brand.default_platform, brand.color_palette)
         )
-        conn.commit()
-        return {"id": brand_id, "message": "Brand created"}
-    finally:
-        conn.close()
+        check_badges(conn, user["user_id"])
+    db_writer.run(write)
+    return {"id": brand_id, "message": "Brand created"}
 
 @app.put("/brands/{brand_id}")
 def update_brand(brand_id: str, brand: BrandUpdate, user=Depends(get_current_user)):
-    conn = get_db()
-    try:
+    def write(conn):
         existing = conn.execute("SELECT * FROM brands WHERE id = ? AND user_id = ?", (brand_id, user["user_id"])).fetchone()
         if not existing:
             raise HTTPException(status_code=404, detail="Brand not found")
@@ -319,20 +1049,13 @@ def update_brand(brand_id: str, brand: BrandUpdate, user=Depends(get_current_use
         if updates:
             set_clause = ", ".join(f"{k} = ?" for k in updates.keys())
             conn.execute(f"UPDATE brands SET {set_clause} WHERE id = ?", (*updates.values(), brand_id))
-            conn.commit()
-        return {"message": "Brand updated"}
-    finally:
-        conn.close()
+    db_writer.run(write)
+    return {"message": "Brand updated"}
 
 @app.delete("/brands/{brand_id}")
 def delete_brand(brand_id: str, user=Depends(get_current_user)):
-    conn = get_db()
-    try:
-        conn.execute("DELETE FROM brands WHERE id = ? AND user_id = ?", (brand_id, user["user_id"]))
-        conn.commit()
-        return {"message": "Brand deleted"}
-    finally:
-        conn.close()
+    db_writer.run(lambda conn: conn.execute("DELETE FROM brands WHERE id = ? AND user_id = ?", (brand_id, user["user_id"])))
+    return {"message": "Brand deleted"}
 
 # ---------- CONTENT GENERATION ----------
 def build_gemini_prompt(req: GenerateRequest) -> str:
@@ -401,130 +1124,851 @@ def build_gemini_prompt(req: GenerateRequest) -> str:
     """
     return base_prompt
 
-async def generate_image_url(prompt: str) -> Optional[str]:
-    if not POLLINATIONS_API_KEY:
+# ---------- UPSTREAM SCHEDULER ----------
+# (user_id, lane) that upstream calls made in the current task are charged to.
+# /generate and friends run in the interactive lane; job workers switch to batch.
+upstream_caller = contextvars.ContextVar("upstream_caller", default=("", "interactive"))
+
+def percentile_ms(sorted_seconds: list, q: float) -> float:
+    if not sorted_seconds:
+        return 0.0
+    return round(sorted_seconds[min(len(sorted_seconds) - 1, int(len(sorted_seconds) * q))] * 1000, 1)
+
+def is_overload_error(e: Exception) -> bool:
+    """429s, 5xx and timeouts: the upstream wants less traffic, not a different request"""
+    return isinstance(e, (
+        google_exceptions.TooManyRequests, google_exceptions.ResourceExhausted, google_exceptions.ServerError,
+        httpx.TimeoutException, asyncio.TimeoutError,
+    ))
+
+class AdaptiveLimit:
+    """AIMD concurrency limit: +1 per window of healthy calls, halved on overload.
+    A call only counts as healthy if it succeeded within 2x the usual latency."""
+    def __init__(self, ceiling: int):
+        self.ceiling = max(1, ceiling)
+        self.value = float(max(1, self.ceiling // 2))
+        self.epoch = 0  # bumped on every decrease
+        self.latency = None  # EWMA of healthy latencies, seconds
+
+    def on_success(self, latency: float):
+        if self.latency is not None and latency > 2 * self.latency:
+            return
+        self.latency = latency if self.latency is None else 0.95 * self.latency + 0.05 * latency
+        self.value = min(self.ceiling, self.value + 1 / self.value)
+
+    def on_overload(self, epoch: int):
+        # calls started before the last cut were sent under the old limit; one cut per window
+        if epoch != self.epoch:
+            return
+        self.value = max(1.0, self.value / 2)
+        self.epoch += 1
+
+class UpstreamCall:
+    """Yielded by FairScheduler.slot(); set `overloaded` for a 429/5xx that came back as a response"""
+    def __init__(self, epoch: int):
+        self.epoch = epoch
+        self.overloaded = False
+
+class FairScheduler:
+    """Admits up to `limit` concurrent calls to one upstream, where the limit adapts (AdaptiveLimit) up to `ceiling`. Waiting calls are served lane by lane
+    (interactive before batch) and, within a lane, by start-time fair queuing across users,
+    so a user with a deep backlog only ever holds their own share of the slots."""
+    LANES = ("interactive", "batch")
+
+    def __init__(self, name: str, ceiling: int):
+        self.name = name
+        self.limit = AdaptiveLimit(ceiling)
+        self.in_flight = 0
+        self._seq = itertools.count()
+        self._heaps = {lane: [] for lane in self.LANES}     # (start tag, seq, future)
+        self._vtime = {lane: 0.0 for lane in self.LANES}    # start tag of the last call served
+        self._finish = {lane: {} for lane in self.LANES}    # user_id -> finish tag of their last call
+        self._queued = {lane: 0 for lane in self.LANES}
+        self._served = {lane: 0 for lane in self.LANES}
+        self._waits = {lane: deque(maxlen=1024) for lane in self.LANES}
+
+    @property
+    def capacity(self) -> int:
+        return int(self.limit.value)
+
+    async def acquire(self, user_id: str, lane: str, weight: float = 1.0):
+        if self.in_flight < self.capacity and not any(self._queued.values()):
+            self.in_flight += 1
+            self._record(lane, 0.0)
+            return
+        enqueued = time.monotonic()
+        start = max(self._vtime[lane], self._finish[lane].get(user_id, 0.0))
+        self._finish[lane][user_id] = start + 1.0 / weight
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heaps[lane], (start, next(self._seq), fut))
+        self._queued[lane] += 1
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.cancelled():
+                self._queued[lane] -= 1  # its heap entry is skipped on the way out
+            else:
+                self.release()  # granted a slot just as we were cancelled
+            raise
+        self._record(lane, time.monotonic() - enqueued)
+
+    def release(self):
+        self.in_flight -= 1
+        self._fill()
+
+    def _fill(self):
+        while self.in_flight < self.capacity:
+            fut = self._next_waiter()
+            if fut is None:
+                break
+            self.in_flight += 1
+            fut.set_result(None)
+
+    def _next_waiter(self):
+        for lane in self.LANES:
+            heap = self._heaps[lane]
+            while heap:
+                start, _, fut = heapq.heappop(heap)
+                if fut.cancelled():
+                    continue
+                self._vtime[lane] = start
+                self._queued[lane] -= 1
+                if not heap:
+                    self._finish[lane].clear()  # lane went idle; nobody carries credit or debt forward
+                return fut
         return None
+
+    def _record(self, lane: str, waited: float):
+        self._served[lane] += 1
+        self._waits[lane].append(waited)
+
+    @asynccontextmanager
+    async def slot(self):
+        user_id, lane = upstream_caller.get()
+        await self.acquire(user_id, lane)
+        call = UpstreamCall(self.limit.epoch)
+        started = time.monotonic()
+        ok = False
+        try:
+            yield call
+            ok = True
+        except Exception as e:
+            call.overloaded = call.overloaded or is_overload_error(e)
+            raise
+        finally:
+            if call.overloaded:
+                self.limit.on_overload(call.epoch)
+            elif ok:
+                self.limit.on_success(time.monotonic() - started)
+            self.release()
+
+    def metrics(self) -> dict:
+        lanes = {}
+        for lane in self.LANES:
+            waits = sorted(self._waits[lane])
+            lanes[lane] = {
+                "queued": self._queued[lane],
+                "served": self._served[lane],
+                "wait_ms_p50": percentile_ms(waits, 0.5),
+                "wait_ms_p95": percentile_ms(waits, 0.95),
+                "wait_ms_max": percentile_ms(waits, 1.0),
+            }
+        return {
+            "limit": round(self.limit.value, 2),
+            "ceiling": self.limit.ceiling,
+            "in_flight": self.in_flight,
+            "lanes": lanes,
+        }
+
+gemini_scheduler = FairScheduler("gemini", GEMINI_MAX_CONCURRENCY)
+pollinations_scheduler = FairScheduler("pollinations", POLLINATIONS_MAX_CONNECTIONS)
+
+@app.get("/metrics/upstream")
+def upstream_metrics():
+    """Current adaptive limit, queue depth, slots in use and recent wait times (over the last 1024 calls per lane) for each upstream"""
+    metrics = {s.name: s.metrics() for s in (gemini_scheduler, pollinations_scheduler)}
+    metrics["pollinations"]["hedges"] = dict(image_hedges)
+    return metrics
+
+# ---------- GEMINI CLIENT ----------
+GEMINI_SAFETY_SETTINGS = [
+    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
+]
+
+_gemini_model = None
+
+def get_gemini_model():
+    """Shared model object, created once per process"""
+    global _gemini_model
+    if _gemini_model is None:
+        _gemini_model = genai.GenerativeModel(GEMINI_MODEL_NAME)
+    return _gemini_model
+
+async def gemini_generate(prompt: str) -> str:
+    """Run a Gemini completion without blocking the event loop.
+    gemini_scheduler caps calls in flight per worker (adaptively, up to GEMINI_MAX_CONCURRENCY)."""
+    async with gemini_scheduler.slot():
+        response = await get_gemini_model().generate_content_async(prompt, safety_settings=GEMINI_SAFETY_SETTINGS)
+    return response.text
+
+async def gemini_stream(prompt: str):
+    """Like gemini_generate, but yields the text as Gemini produces it"""
+    async with gemini_scheduler.slot():
+        response = await get_gemini_model().generate_content_async(prompt, safety_settings=GEMINI_SAFETY_SETTINGS, stream=True)
+        async for chunk in response:
+            try:
+                text = chunk.text
+            except ValueError:
+                continue  # chunk without text parts (e.g. a bare finish reason)
+            if text:
+                yield text
+
+# ---------- POLLINATIONS CLIENT ----------
+_pollinations_client = None
+
+def get_pollinations_client() -> httpx.AsyncClient:
+    """Keep-alive connection pool to the Pollinations host, shared by every image fetch"""
+    global _pollinations_client
+    if _pollinations_client is None:
+        _pollinations_client = httpx.AsyncClient(
+            base_url=POLLINATIONS_BASE_URL,
+            timeout=httpx.Timeout(60.0, connect=10.0, pool=30.0),
+            limits=httpx.Limits(
+                max_connections=POLLINATIONS_MAX_CONNECTIONS,
+                max_keepalive_connections=POLLINATIONS_MAX_CONNECTIONS,
+                keepalive_expiry=60.0,
+            ),
+        )
+    return _pollinations_client
+
+async def fetch_pollinations_image(prompt: str, model: str = "flux") -> httpx.Response:
     prompt_encoded = urllib.parse.quote(prompt)
-    API_URL = f"https://gen.pollinations.ai/image/{prompt_encoded}?model=flux"
     headers = {"Authorization": f"Bearer {POLLINATIONS_API_KEY}"}
+    async with pollinations_scheduler.slot() as call:
+        response = await get_pollinations_client().get(f"/image/{prompt_encoded}", params={"model": model}, headers=headers)
+        call.overloaded = response.status_code == 429 or response.status_code >= 500
+        return response
+
+# Recent successful fetch latencies; a fetch running longer than their p95 gets hedged
+_image_latencies = deque(maxlen=256)
+image_hedges = {"sent": 0, "won": 0}
+
+def image_hedge_delay() -> Optional[float]:
+    if not IMAGE_HEDGING or len(_image_latencies) < 20:
+        return None
+    ordered = sorted(_image_latencies)
+    return ordered[int(len(ordered) * 0.95)]
+
+async def _fetch_image_bytes(prompt: str, model: str) -> Optional[bytes]:
+    started = time.monotonic()
+    response = await fetch_pollinations_image(prompt, model)
+    if response.status_code != 200:
+        return None
+    _image_latencies.append(time.monotonic() - started)
+    return response.content
+
+async def fetch_image_hedged(prompt: str, model: str) -> Optional[bytes]:
+    """Fetch an image; if it is still running after the p95 delay and a slot is free,
+    send a second request and keep whichever good answer arrives first"""
+    primary = asyncio.ensure_future(_fetch_image_bytes(prompt, model))
+    tasks = {primary}
     try:
-        response = requests.get(API_URL, headers=headers, timeout=60)
-        if response.status_code != 200:
+        delay = image_hedge_delay()
+        if delay is not None:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done and pollinations_scheduler.in_flight < pollinations_scheduler.capacity:
+                tasks.add(asyncio.ensure_future(_fetch_image_bytes(prompt, model)))
+                image_hedges["sent"] += 1
+        pending, error = tasks, None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    error = task.exception()
+                elif task.result():
+                    if task is not primary:
+                        image_hedges["won"] += 1
+                    return task.result()
+        if error is not None:
+            raise error
+        return None
+    finally:
+        for task in tasks:
+            task.cancel()
+
+# (prompt, model) -> task of the fetch currently in flight for it
+_image_fetches = {}
+
+async def generate_image_url(prompt: str, model: str = "flux") -> Optional[str]:
+    """Concurrent callers asking for the same prompt share one upstream fetch and one stored blob"""
+    if not POLLINATIONS_API_KEY:
+        return None
+    key = (prompt, model)
+    task = _image_fetches.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_fetch_and_store_image(prompt, model))
+        _image_fetches[key] = task
+        task.add_done_callback(lambda _: _image_fetches.pop(key, None))
+    # shield: one caller giving up must not cancel the fetch the others are waiting on
+    return await asyncio.shield(task)
+
+async def _fetch_and_store_image(prompt: str, model: str) -> Optional[str]:
+    try:
+        content = await fetch_image_hedged(prompt, model)
+        if content is None:
             return None
-        image_bytes = response.content
-        base64_image = base64.b64encode(image_bytes).decode('utf-8')
-        return f"data:image/jpeg;base64,{base64_image}"
+        return await asyncio.to_thread(store_image, content)
     except Exception as e:
         print(f"Image gen failed: {e}")
         return None
 
+# ---------- GENERATION CACHE ----------
+class TTLCache:
+    """Thread-safe LRU with a per-entry expiry; disabled when size or ttl is 0.
+    With max_bytes, entries put() with a size are also evicted to keep their total under it."""
+    def __init__(self, max_entries: int, ttl_seconds: float, max_bytes: int = 0):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0 and self.ttl_seconds > 0
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires_at, value, size = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                self._bytes -= size
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value, size: int = 0):
+        if not self.enabled:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+            self._data[key] = (time.monotonic() + self.ttl_seconds, value, size)
+            self._bytes += size
+            while len(self._data) > self.max_entries or (self.max_bytes and self._bytes > self.max_bytes and len(self._data) > 1):
+                _, (_, _, evicted) = self._data.popitem(last=False)
+                self._bytes -= evicted
+
+generation_cache = TTLCache(GENERATION_CACHE_SIZE, GENERATION_CACHE_TTL)
+
+def generation_cache_key(prompt: str) -> str:
+    return hashlib.sha256(" ".join(prompt.split()).encode()).hexdigest()
+
+# ---------- RESPONSE CACHE ----------
+# Per-user reads (/brands, /campaigns, /scheduled, /evergreen, /approvals, /gamification) are cached
+# as rendered JSON under users.data_version, which triggers bump in the same transaction as every
+# write to that user's data (migration 13), so every worker sees every other worker's writes. A read
+# takes the version before it queries, so a result racing a write is stored under the old version and
+# never served. RESPONSE_CACHE_TTL bounds how stale evergreen's time-based fields can get.
+response_cache = TTLCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, RESPONSE_CACHE_MB * 1024 * 1024)
+
+def user_data_version(user_id: str) -> int:
+    conn = get_db()
+    try:
+        row = conn.execute("SELECT data_version FROM users WHERE id = ?", (user_id,)).fetchone()
+        return row["data_version"] if row else 0
+    finally:
+        conn.close()
+
+def cached_user_response(request: Request, user_id: str, build) -> Response:
+    """Serve build()'s result as JSON from the response cache, with an ETag and 304 for If-None-Match"""
+    version = user_data_version(user_id) if response_cache.enabled else 0
+    key = (user_id, request.url.path, request.url.query, version)
+    entry = response_cache.get(key)
+    if entry is None:
+        body = JSONResponse(jsonable_encoder(build())).body
+        entry = (f'"{hashlib.blake2b(body, digest_size=12).hexdigest()}"', body)
+        response_cache.put(key, entry, size=len(body))
+    etag, body = entry
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if_none_match = request.headers.get("if-none-match", "")
+    if if_none_match == "*" or etag in (t.strip().removeprefix("W/") for t in if_none_match.split(",")):
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
+
+# ---------- GENERATION PIPELINE ----------
+def parse_generation(text_response: str, num_variations: int) -> List[dict]:
+    """Gemini JSON -> [{script, visual_prompt}], one entry per variation"""
+    clean_text = text_response.replace("```json", "").replace("```", "").strip()
+    data = json.loads(clean_text)
+    if num_variations > 1:
+        return [{"script": v.get("script", ""), "visual_prompt": v.get("image_prompt", "")} for v in data.get("variations", [])]
+    return [{"script": data.get("script", text_response), "visual_prompt": data.get("image_prompt", "")}]
+
+class ScriptStreamExtractor:
+    """Pulls the decoded value of every "script" key out of Gemini's JSON while it is still
+    streaming, so the caption can be shown before the JSON is complete.
+    feed(chunk) -> [(variation_index, text_delta), ...]"""
+    KEY_RE = re.compile(r'"script"\s*:\s*"')
+    ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+    def __init__(self):
+        self.buf = ""
+        self.pos = 0
+        self.index = -1
+        self.in_script = False
+
+    def feed(self, chunk: str) -> list:
+        self.buf += chunk
+        deltas = []
+        while True:
+            if not self.in_script:
+                m = self.KEY_RE.search(self.buf, self.pos)
+                if not m:
+                    return deltas
+                self.pos = m.end()
+                self.in_script = True
+                self.index += 1
+            text, done = self._read_string()
+            if text:
+                deltas.append((self.index, text))
+            if not done:
+                return deltas
+            self.in_script = False
+
+    def _read_string(self):
+        out = []
+        buf, i = self.buf, self.pos
+        while i < len(buf):
+            c = buf[i]
+            if c == '"':
+                self.pos = i + 1
+                return "".join(out), True
+            if c != '\\':
+                out.append(c)
+                i += 1
+                continue
+            if i + 1 >= len(buf):
+                break
+            if buf[i + 1] != 'u':
+                out.append(self.ESCAPES.get(buf[i + 1], buf[i + 1]))
+                i += 2
+                continue
+            # \uXXXX, plus its low half when it is a surrogate pair
+            end = i + 12 if buf[i + 2:i + 4].lower() in ("d8", "d9", "da", "db") else i + 6
+            if end > len(buf):
+                break
+            try:
+                out.append(json.loads(f'"{buf[i:end]}"'))
+            except ValueError:
+                pass
+            i = end
+        self.pos = i
+        return "".join(out), False
+
+def time_left(deadline: Optional[float]) -> Optional[float]:
+    """Seconds until a time.monotonic() deadline, for asyncio timeouts; None means no deadline"""
+    return None if deadline is None else max(0.0, deadline - time.monotonic())
+
+async def _image_for(index: int, prompt: str):
+    try:
+        return index, await generate_image_url(prompt)
+    except Exception as e:
+        print(f"Image gen failed: {e}")
+        return index, None
+
+# generation id -> task finishing an image that outlived its request's deadline
+_deferred_images = {}
+
+async def _finish_deferred_image(gen_id: str, image_task: asyncio.Future, deadline: float):
+    try:
+        try:
+            _, image_url = await asyncio.wait_for(image_task, max(0.0, deadline - time.time()))
+        except asyncio.TimeoutError:
+            print(f"Deferred image for {gen_id} missed its deadline")
+            image_url = None
+        # landed or failed, either way no longer pending
+        await db_writer.run_async(lambda conn: conn.execute(
+            "UPDATE generations SET image_url = ?, image_deadline = 0 WHERE id = ? AND image_url = ''", (image_url or "", gen_id)))
+    finally:
+        _deferred_images.pop(gen_id, None)
+
+def defer_image(gen_id: str, image_task: asyncio.Future, deadline: float) -> str:
+    """Let the fetch finish in the background, until the image_deadline saved on its row, and return
+    the reference to poll for it"""
+    _deferred_images[gen_id] = asyncio.ensure_future(_finish_deferred_image(gen_id, image_task, deadline))
+    return f"/history/{gen_id}/image"
+
+def save_generations(conn, user_id: str, req: GenerateRequest, pieces: List[dict], num_variations: int,
+                     row_extras: Optional[dict] = None) -> List[dict]:
+    """Unit of work for db_writer: the generation rows, their analytics event and any badges they earn.
+    row_extras: additional generations columns (e.g. campaign_id, scheduled_date) for every row"""
+    extras = row_extras or {}
+    extra_cols = "".join(f", {k}" for k in extras)
+    placeholders = ",".join("?" * (12 + len(extras)))
+    results = []
+    for p in pieces:
+        gen_id = str(uuid.uuid4())
+        share_id = secrets.token_urlsafe(8)
+        conn.execute(
+            f"INSERT INTO generations (id, user_id, brand_name, topic, platform, tone, level, script, visual_prompt, image_url, image_deadline, share_id{extra_cols}) VALUES ({placeholders})",
+            (gen_id, user_id, req.brand_name, req.topic, req.platform, req.tone, req.level, p["script"], p["visual_prompt"], p["image_url"] or "",
+             p.get("image_deadline", 0), share_id, *extras.values())
+        )
+        results.append({
+            "id": gen_id,
+            "script": p["script"],
+            "visual_prompt": p["visual_prompt"],
+            "image_url": p["image_url"],
+            "share_id": share_id
+        })
+
+    # Track analytics
+    metadata = {"brand": req.brand_name, "platform": req.platform}
+    if num_variations > 1:
+        metadata["variations"] = num_variations
+    conn.execute("INSERT INTO analytics (user_id, action, metadata) VALUES (?, ?, ?)",
+        (user_id, "generate", json.dumps(metadata)))
+    check_badges(conn, user_id)
+    return results
+
+async def generation_events(req: GenerateRequest, user_id: str, stream_text: bool = False, row_extras: Optional[dict] = None,
+                            deadline: Optional[float] = None):
+    """prompt -> text -> images -> persist, yielding (event, data) as each piece is ready:
+    stage, script (text deltas, token by token when stream_text), visual_prompt, image,
+    and finally done with the /generate response body.
+    deadline (time.monotonic()) bounds the whole run: text past it is a TimeoutError, images
+    past it are finished in the background and returned as an image_deferred reference."""
+    prompt = build_gemini_prompt(req)
+    num_variations = min(max(req.variations, 1), 3)
+    
+    # Identical prompts (e.g. repeated template runs) reuse the text and images;
+    # each run still gets its own generation rows
+    cache_key = generation_cache_key(prompt)
+    pieces = None if req.fresh else generation_cache.get(cache_key)
+    cached = pieces is not None
+    if cached:
+        for i, p in enumerate(pieces):
+            yield "script", {"index": i, "delta": p["script"]}
+    else:
+        yield "stage", {"stage": "text"}
+        if stream_text:
+            extractor = ScriptStreamExtractor()
+            chunks = []
+            stream = gemini_stream(prompt)
+            try:
+                while True:
+                    try:
+                        chunk = await asyncio.wait_for(anext(stream), time_left(deadline))
+                    except StopAsyncIteration:
+                        break
+                    chunks.append(chunk)
+                    for i, delta in extractor.feed(chunk):
+                        yield "script", {"index": i, "delta": delta}
+            finally:
+                await stream.aclose()
+            pieces = parse_generation("".join(chunks), num_variations)
+        else:
+            text = await asyncio.wait_for(gemini_generate(prompt), time_left(deadline))
+            pieces = parse_generation(text, num_variations)
+    for i, p in enumerate(pieces):
+        yield "visual_prompt", {"index": i, "visual_prompt": p["visual_prompt"]}
+    
+    deferred = {}  # piece index -> image task still running at the deadline
+    if cached:
+        for i, p in enumerate(pieces):
+            yield "image", {"index": i, "image_url": p["image_url"]}
+    else:
+        yield "stage", {"stage": "images"}
+        # Fetch every piece's image at once; a failed or timed-out image
+        # just leaves that piece without one
+        image_tasks = {asyncio.ensure_future(_image_for(i, p["visual_prompt"])): i for i, p in enumerate(pieces)}
+        pending = set(image_tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, timeout=time_left(deadline), return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                break
+            for task in done:
+                i, image_url = task.result()
+                pieces[i]["image_url"] = image_url
+                yield "image", {"index": i, "image_url": image_url}
+        for task in pending:
+            deferred[image_tasks[task]] = task
+            pieces[image_tasks[task]]["image_url"] = None
+            pieces[image_tasks[task]]["image_deadline"] = time.time() + IMAGE_DEFER_SECONDS
+        if not deferred and (all(p["image_url"] for p in pieces) or not POLLINATIONS_API_KEY):
+            generation_cache.put(cache_key, pieces)
+    
+    yield "stage", {"stage": "saving"}
+    results = await db_writer.run_async(
+        lambda conn: save_generations(conn, user_id, req, pieces, num_variations, row_extras))
+    for i, task in deferred.items():
+        results[i]["image_deferred"] = defer_image(results[i]["id"], task, pieces[i]["image_deadline"])
+        yield "image", {"index": i, "image_url": None, "image_deferred": results[i]["image_deferred"]}
+    
+    if num_variations > 1:
+        yield "done", {"variations": results, "cached": cached}
+    else:
+        yield "done", {**results[0], "cached": cached}
+
+async def run_generation(req: GenerateRequest, user_id: str, on_stage=None, row_extras: Optional[dict] = None,
+                         deadline: Optional[float] = None) -> dict:
+    """Run the whole pipeline and return the /generate response body"""
+    async for event, data in generation_events(req, user_id, row_extras=row_extras, deadline=deadline):
+        if event == "stage" and on_stage:
+            on_stage(data["stage"])
+        elif event == "done":
+            return data
+
+def generation_error_detail(e: Exception) -> str:
+    if isinstance(e, (asyncio.TimeoutError, httpx.TimeoutException)):
+        return "AI provider took too long, please retry shortly"
+    if is_overload_error(e):
+        return "AI provider is busy, please retry shortly"
+    if isinstance(e, json.JSONDecodeError):
+        return "Failed to parse AI response"
+    if isinstance(e, HTTPException):
+        return e.detail
+    return f"Generation error: {str(e)}"
+
 @app.post("/generate")
 async def generate_content(req: GenerateRequest, request: Request, user=Depends(get_current_user)):
-    check_rate_limit(user["user_id"], max_calls=20, window_seconds=60)
+    await check_rate_limit_async(user["user_id"], max_calls=20, window_seconds=60)
     
     if not GENAI_KEY:
         raise HTTPException(status_code=500, detail="Gemini API key not configured")
     
+    upstream_caller.set((user["user_id"], "interactive"))
     try:
-        prompt = build_gemini_prompt(req)
-        num_variations = min(max(req.variations, 1), 3)
-        
-        safety_settings = [
-            {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-            {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-            {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
-            {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
-        ]
+        return await run_generation(req, user["user_id"], deadline=time.monotonic() + GENERATION_DEADLINE)
+    except HTTPException:
+        raise
+    except Exception as e:
+        if is_overload_error(e):
+            raise HTTPException(status_code=503, detail=generation_error_detail(e), headers={"Retry-After": "5"})
+        raise HTTPException(status_code=500, detail=generation_error_detail(e))
 
-        model = genai.GenerativeModel("gemini-2.5-flash")
-        response = model.generate_content(prompt, safety_settings=safety_settings)
-        text_response = response.text
-        
-        clean_text = text_response.replace("```json", "").replace("```", "").strip()
-        
-        conn = get_db()
+def sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.post("/generate/stream")
+async def generate_content_stream(req: GenerateRequest, user=Depends(get_current_user)):
+    """Server-sent events version of /generate: script deltas as Gemini writes them, then each
+    visual_prompt and image as it lands, then `done` with the usual response body (or `error`)"""
+    await check_rate_limit_async(user["user_id"], max_calls=20, window_seconds=60)
+    
+    if not GENAI_KEY:
+        raise HTTPException(status_code=500, detail="Gemini API key not configured")
+    
+    async def events():
+        upstream_caller.set((user["user_id"], "interactive"))
+        deadline = time.monotonic() + GENERATION_DEADLINE
         try:
-            if num_variations > 1:
-                data = json.loads(clean_text)
-                variations = data.get("variations", [])
-                results = []
-                for v in variations:
-                    gen_id = str(uuid.uuid4())
-                    share_id = secrets.token_urlsafe(8)
-                    script = v.get("script", "")
-                    visual_prompt = v.get("image_prompt", "")
-                    image_url = await generate_image_url(visual_prompt)
-                    
-                    conn.execute(
-                        "INSERT INTO generations (id, user_id, brand_name, topic, platform, tone, level, script, visual_prompt, image_url, share_id) VALUES (?,?,?,?,?,?,?,?,?,?,?)",
-                        (gen_id, user["user_id"], req.brand_name, req.topic, req.platform, req.tone, req.level, script, visual_prompt, image_url or "", share_id)
-                    )
-                    results.append({
-                        "id": gen_id,
-                        "script": script,
-                        "visual_prompt": visual_prompt,
-                        "image_url": image_url,
-                        "share_id": share_id
-                    })
-                conn.commit()
-                
-                # Track analytics
-                conn.execute("INSERT INTO analytics (user_id, action, metadata) VALUES (?, ?, ?)",
-                    (user["user_id"], "generate", json.dumps({"brand": req.brand_name, "platform": req.platform, "variations": num_variations})))
-                conn.commit()
-                
-                return {"variations": results}
-            else:
-                data = json.loads(clean_text)
-                script = data.get("script", text_response)
-                visual_prompt = data.get("image_prompt", "")
-                
-                image_url = await generate_image_url(visual_prompt)
-                
-                gen_id = str(uuid.uuid4())
-                share_id = secrets.token_urlsafe(8)
-                conn.execute(
-                    "INSERT INTO generations (id, user_id, brand_name, topic, platform, tone, level, script, visual_prompt, image_url, share_id) VALUES (?,?,?,?,?,?,?,?,?,?,?)",
-                    (gen_id, user["user_id"], req.brand_name, req.topic, req.platform, req.tone, req.level, script, visual_prompt, image_url or "", share_id)
-                )
-                conn.commit()
-                
-                # Track analytics
-                conn.execute("INSERT INTO analytics (user_id, action, metadata) VALUES (?, ?, ?)",
-                    (user["user_id"], "generate", json.dumps({"brand": req.brand_name, "platform": req.platform})))
-                conn.commit()
-                
-                return {
-                    "id": gen_id,
-                    "script": script,
-                    "visual_prompt": visual_prompt,
-                    "image_url": image_url,
-                    "share_id": share_id
-                }
+            async for event, data in generation_events(req, user["user_id"], stream_text=True, deadline=deadline):
+                yield sse_event(event, data)
+        except Exception as e:
+            yield sse_event("error", {"detail": generation_error_detail(e)})
+    
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# ---------- GENERATION JOBS ----------
+# Job state lives in SQLite. A worker holds a job under a lease that every stage renews;
+# a job whose lease runs out (its process died or restarted) is claimed again by any worker.
+_job_wakeup = None
+_job_loop = None
+_job_workers = []
+
+def get_job_wakeup() -> asyncio.Event:
+    global _job_wakeup
+    if _job_wakeup is None:
+        _job_wakeup = asyncio.Event()
+    return _job_wakeup
+
+def notify_job_workers():
+    """Wake idle workers early (they also poll); safe to call from any thread"""
+    if _job_loop is not None:
+        _job_loop.call_soon_threadsafe(get_job_wakeup().set)
+
+def enqueue_job(conn, user_id: str, kind: str, request: dict, batch_id: str = "") -> str:
+    """Unit of work for db_writer; call notify_job_workers() once it has committed"""
+    job_id = str(uuid.uuid4())
+    conn.execute("INSERT INTO jobs (id, user_id, kind, request, batch_id) VALUES (?,?,?,?,?)",
+                 (job_id, user_id, kind, json.dumps(request), batch_id))
+    return job_id
+
+def claim_job(conn):
+    """Unit of work for db_writer: take the next job, or None when there is nothing to do.
+    The user with the fewest running jobs goes first (their oldest job), so one user's batch
+    can't starve another user's single job, and nobody runs more than JOB_USER_CONCURRENCY.
+    A running job whose lease ran out counts as queued."""
+    now = time.time()
+    running = dict(conn.execute(
+        "SELECT user_id, COUNT(*) FROM jobs WHERE status = 'running' AND lease_until >= ? GROUP BY user_id",
+        (now,)
+    ).fetchall())
+    # Each user's oldest claimable job (SQLite takes the bare id column from the MIN() row)
+    heads = conn.execute("""
+        SELECT user_id, MIN(created_at) AS oldest, id FROM jobs WHERE status = 'queued' GROUP BY user_id
+        UNION ALL
+        SELECT user_id, MIN(created_at), id FROM jobs WHERE status = 'running' AND lease_until < ? GROUP BY user_id
+    """, (now,)).fetchall()
+    eligible = [(running.get(r["user_id"], 0), r["oldest"], r["id"]) for r in heads
+                if running.get(r["user_id"], 0) < JOB_USER_CONCURRENCY]
+    if not eligible:
+        return None
+    _, _, job_id = min(eligible)
+    conn.execute(
+        "UPDATE jobs SET status='running', attempts=attempts+1, lease_until=?, updated_at=datetime('now') WHERE id=?",
+        (now + JOB_LEASE_SECONDS, job_id)
+    )
+    return dict(conn.execute("SELECT * FROM jobs WHERE id=?", (job_id,)).fetchone())
+
+def update_job(conn, job_id: str, **fields):
+    """Unit of work for db_writer"""
+    fields["updated_at"] = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+    if fields.get("status") == "running":
+        fields["lease_until"] = time.time() + JOB_LEASE_SECONDS
+    set_clause = ", ".join(f"{k} = ?" for k in fields.keys())
+    conn.execute(f"UPDATE jobs SET {set_clause} WHERE id = ?", (*fields.values(), job_id))
+
+# seconds a job worker waits after the database refuses it, doubling up to the second value. A lock
+# held past busy_timeout (a VACUUM or rebuild-analytics in another process) then only pauses the queue.
+JOB_DB_RETRY = (0.5, 30.0)
+
+async def retry_on_db_error(what: str, write):
+    """Await write() until the database accepts it"""
+    delay = JOB_DB_RETRY[0]
+    while True:
+        try:
+            return await write()
+        except sqlite3.OperationalError as e:
+            print(f"{what} failed ({e}); retrying in {delay:g}s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, JOB_DB_RETRY[1])
+
+async def finish_job(job_id: str, **fields):
+    """Retried rather than dropped: a job whose outcome isn't recorded would run again once its
+    lease expires, repeating work (and generations) that already happened"""
+    await retry_on_db_error(f"Finishing job {job_id}",
+                            lambda: db_writer.run_async(lambda conn: update_job(conn, job_id, **fields)))
+
+def job_stage_reporter(job_id: str):
+    """on_stage callback: record progress and renew the lease without waiting for the commit"""
+    return lambda name: db_writer.submit(lambda conn: update_job(conn, job_id, status="running", stage=name))
+
+async def run_generate_job(job: dict) -> dict:
+    req = GenerateRequest(**json.loads(job["request"]))
+    return await run_generation(req, job["user_id"], on_stage=job_stage_reporter(job["id"]))
+
+JOB_HANDLERS = {"generate": run_generate_job}
+
+async def job_worker():
+    wakeup = get_job_wakeup()
+    while True:
+        try:
+            await run_next_job(wakeup)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # keep the worker alive; whatever it held comes back when its lease expires
+            print(f"Job worker error: {e}")
+            await asyncio.sleep(JOB_DB_RETRY[0])
+
+async def run_next_job(wakeup: asyncio.Event):
+    job = await retry_on_db_error("Claiming a job", lambda: db_writer.run_async(claim_job))
+    if job is None:
+        wakeup.clear()
+        # Also poll, to pick up jobs queued by other processes and expired leases. Not wait_for:
+        # before 3.12 it drops a cancel that lands as the wakeup fires, and shutdown never ends
+        woken = asyncio.ensure_future(wakeup.wait())
+        try:
+            await asyncio.wait((woken,), timeout=2.0)
         finally:
-            conn.close()
-            
-    except json.JSONDecodeError:
-        raise HTTPException(status_code=500, detail="Failed to parse AI response")
-    except HTTPException:
+            woken.cancel()
+        return
+    if job["attempts"] > JOB_MAX_ATTEMPTS:
+        await finish_job(job["id"], status="failed", stage="failed", error=f"Gave up after {JOB_MAX_ATTEMPTS} attempts")
+        return
+    upstream_caller.set((job["user_id"], "batch"))
+    try:
+        result = json.dumps(await JOB_HANDLERS[job["kind"]](job))
+    except asyncio.CancelledError:
+        # Shutting down: hand the job straight back instead of waiting out the lease (once; if the
+        # database is busy the lease expiring does the same)
+        try:
+            await db_writer.run_async(lambda conn: update_job(conn, job["id"], status="queued", stage="queued"))
+        except sqlite3.OperationalError:
+            pass
         raise
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Generation error: {str(e)}")
+        print(f"Job {job['id']} failed: {e}")
+        await finish_job(job["id"], status="failed", stage="failed", error=generation_error_detail(e))
+    else:
+        await finish_job(job["id"], status="done", stage="done", result=result)
+    # a finished job may free a slot for one of this user's waiting jobs
+    wakeup.set()
+
+@app.on_event("startup")
+async def start_job_workers():
+    global _job_loop
+    _job_loop = asyncio.get_running_loop()
+    for _ in range(JOB_WORKERS):
+        _job_workers.append(asyncio.create_task(job_worker()))
+
+async def stop_job_workers():
+    for task in _job_workers:
+        task.cancel()
+    await asyncio.gather(*_job_workers, return_exceptions=True)
+    _job_workers.clear()
+
+@app.post("/generate/jobs")
+async def submit_generate_job(req: GenerateRequest, user=Depends(get_current_user)):
+    """Queue a generation and return at once; poll /jobs/{job_id} for progress and the result"""
+    await check_rate_limit_async(user["user_id"], max_calls=20, window_seconds=60)
+    if not GENAI_KEY:
+        raise HTTPException(status_code=500, detail="Gemini API key not configured")
+    job_id = await db_writer.run_async(lambda conn: enqueue_job(conn, user["user_id"], "generate", req.dict()))
+    notify_job_workers()
+    return {"job_id": job_id, "status": "queued"}
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str, user=Depends(get_current_user)):
+    conn = get_db()
+    try:
+        row = conn.execute(
+            "SELECT id, kind, status, stage, result, error, attempts, created_at, updated_at FROM jobs WHERE id = ? AND user_id = ?",
+            (job_id, user["user_id"])
+        ).fetchone()
+        if not row:
+            raise HTTPException(status_code=404, detail="Job not found")
+        job = dict(row)
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+    finally:
+        conn.close()
 
 # ---------- IMAGE GENERATION ----------
 @app.post("/generate-image")
 async def generate_image(req: ImageGenerateRequest, user=Depends(get_current_user)):
-    check_rate_limit(user["user_id"], max_calls=10, window_seconds=60)
+    await check_rate_limit_async(user["user_id"], max_calls=10, window_seconds=60)
     
     if not POLLINATIONS_API_KEY:
         raise HTTPException(status_code=500, detail="Pollinations API Key is missing")
     
-    prompt_encoded = urllib.parse.quote(req.prompt)
-    API_URL = f"https://gen.pollinations.ai/image/{prompt_encoded}?model=flux"
-    headers = {"Authorization": f"Bearer {POLLINATIONS_API_KEY}"}
-
+    upstream_caller.set((user["user_id"], "interactive"))
     try:
-        response = requests.get(API_URL, headers=headers, timeout=60)
+        response = await fetch_pollinations_image(req.prompt)
         if response.status_code != 200:
             raise HTTPException(status_code=response.status_code, detail=f"Pollinations API Error")
         image_bytes = response.content
@@ -535,24 +1979,159 @@ async def generate_image(req: ImageGenerateRequest, user=Depends(get_current_use
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# ---------- IMAGES ----------
+@app.get("/images/{image_hash}")
+def get_image(image_hash: str, request: Request):
+    """Public - the content hash is the capability, and the bytes never change"""
+    if not IMAGE_HASH_RE.fullmatch(image_hash):
+        raise HTTPException(status_code=404, detail="Image not found")
+    path = image_path(image_hash)
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Image not found")
+    etag = f'"{image_hash}"'
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=31536000, immutable"}
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    with open(path, "rb") as f:
+        media_type = sniff_image_type(f.read(12))
+    return FileResponse(path, media_type=media_type, headers=headers)
+
+# ---------- FIELD PROJECTION ----------
+GENERATION_COLUMNS = {c: c for c in [
+    "id", "user_id", "brand_name", "topic", "platform", "tone", "level", "script", "visual_prompt", "image_url",
+    "share_id", "is_evergreen", "recycle_days", "status", "campaign_id", "scheduled_date", "created_at",
+]}
+GENERATION_SUMMARY = ["id", "brand_name", "topic", "platform", "tone", "script", "image_url", "share_id",
+                      "is_evergreen", "recycle_days", "status", "scheduled_date", "created_at"]
+
+APPROVAL_COLUMNS = {
+    **{c: f"a.{c}" for c in ["id", "generation_id", "user_id", "status", "reviewer_notes", "submitted_at", "reviewed_at", "created_at"]},
+    **{c: f"g.{c}" for c in ["script", "brand_name", "platform", "image_url"]},
+}
+APPROVAL_SUMMARY = ["id", "generation_id", "status", "reviewer_notes", "submitted_at", "reviewed_at", "created_at",
+                    "script", "brand_name", "platform"]
+
+def project_fields(fields: Optional[str], columns: dict, summary: list, required=()):
+    """Turn ?fields= into a SELECT list. 'summary' (the default) and 'full' are preset shapes,
+    anything else is a comma-separated column list. Returns (select_sql, requested_names);
+    `required` columns are selected for the handler's own use even when not requested."""
+    if not fields or fields == "summary":
+        names = list(summary)
+    elif fields == "full":
+        names = list(columns)
+    else:
+        names = list(dict.fromkeys(f.strip() for f in fields.split(",") if f.strip()))
+        unknown = [n for n in names if n not in columns]
+        if unknown or not names:
+            raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    selected = names + [c for c in required if c not in names]
+    select_sql = ", ".join(columns[n] if columns[n] == n else f"{columns[n]} AS {n}" for n in selected)
+    return select_sql, names
+
+def trim_row(row: dict, names: list, extra=()) -> dict:
+    return {k: v for k, v in row.items() if k in names or k in extra}
+
 # ---------- HISTORY ----------
+HISTORY_COUNT_CAP = 10000  # count="estimate" stops counting here
+
+def encode_cursor(created_at: str, gen_id: str) -> str:
+    return base64.urlsafe_b64encode(json.dumps([created_at, gen_id]).encode()).decode()
+
+def decode_cursor(cursor: str):
+    try:
+        created_at, gen_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return str(created_at), str(gen_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
 @app.get("/history")
-def get_history(user=Depends(get_current_user), limit: int = 50, offset: int = 0, brand: str = None, platform: str = None):
+def get_history(user=Depends(get_current_user), limit: int = 50, offset: int = 0, brand: str = None, platform: str = None,
+                cursor: str = None, count: str = "exact", fields: str = None):
+    """Newest first. Pass the returned next_cursor back as `cursor` for constant-cost deep pages
+    (offset is still honoured without one). count: exact | estimate (capped) | none"""
+    select_sql, names = project_fields(fields, GENERATION_COLUMNS, GENERATION_SUMMARY, required=("id", "created_at"))
+    if count not in ("exact", "estimate", "none"):
+        raise HTTPException(status_code=400, detail="count must be exact, estimate or none")
     conn = get_db()
     try:
-        query = "SELECT * FROM generations WHERE user_id = ?"
+        where = "user_id = ?"
         params = [user["user_id"]]
         if brand:
-            query += " AND brand_name LIKE ?"
+            where += " AND brand_name LIKE ?"
             params.append(f"%{brand}%")
         if platform:
-            query += " AND platform LIKE ?"
+            where += " AND platform LIKE ?"
             params.append(f"%{platform}%")
-        query += " ORDER BY created_at DESC LIMIT ? OFFSET ?"
-        params.extend([limit, offset])
-        rows = conn.execute(query, params).fetchall()
-        total = conn.execute("SELECT COUNT(*) FROM generations WHERE user_id = ?", (user["user_id"],)).fetchone()[0]
-        return {"items": [dict(r) for r in rows], "total": total}
+
+        query = f"SELECT {select_sql} FROM generations WHERE {where}"
+        page_params = list(params)
+        if cursor:
+            query += " AND (created_at, id) < (?, ?)"
+            page_params.extend(decode_cursor(cursor))
+        query += " ORDER BY created_at DESC, id DESC LIMIT ?"
+        page_params.append(limit)
+        if not cursor:
+            query += " OFFSET ?"
+            page_params.append(offset)
+        rows = [dict(r) for r in conn.execute(query, page_params).fetchall()]
+        next_cursor = encode_cursor(rows[-1]["created_at"], rows[-1]["id"]) if rows and len(rows) == limit else None
+        items = [trim_row(r, names) for r in rows]
+
+        total, total_exact = None, False
+        if count == "exact":
+            total = conn.execute(f"SELECT COUNT(*) FROM generations WHERE {where}", params).fetchone()[0]
+            total_exact = True
+        elif count == "estimate":
+            total = conn.execute(f"SELECT COUNT(*) FROM (SELECT 1 FROM generations WHERE {where} LIMIT ?)",
+                                 (*params, HISTORY_COUNT_CAP)).fetchone()[0]
+            total_exact = total < HISTORY_COUNT_CAP
+        return {"items": items, "total": total, "total_exact": total_exact, "next_cursor": next_cursor}
+    finally:
+        conn.close()
+
+def fts_phrase(text: str) -> str:
+    return '"' + text.replace('"', '""') + '"'
+
+def build_search_query(user_id: str, q: str) -> str:
+    """Quote every term so user input can't break FTS5 syntax; the last term is a prefix
+    match for search-as-you-type. The user_id token scopes the match to one tenant, and the
+    terms only match the content columns, never that token."""
+    terms = [fts_phrase(t) for t in q.split()]
+    if not terms:
+        raise HTTPException(status_code=400, detail="Search query is empty")
+    terms[-1] += "*"
+    return f"user_id : {fts_phrase(user_id.replace('-', ''))} AND {{topic script visual_prompt}} : (" + " AND ".join(terms) + ")"
+
+# snippet() marks matches with these control characters so the text around them can be
+# HTML-escaped before they become <mark> tags
+SNIPPET_START, SNIPPET_END = "\x02", "\x03"
+
+def render_snippet(snippet: Optional[str]) -> str:
+    return html.escape(snippet or "").replace(SNIPPET_START, "<mark>").replace(SNIPPET_END, "</mark>")
+
+@app.get("/history/search")
+def search_history(q: str, user=Depends(get_current_user), limit: int = 20, offset: int = 0):
+    """Ranked full-text search over topic, script and visual prompt. The snippets are HTML: escaped
+    text with <mark> around the matches"""
+    limit = min(max(limit, 1), 100)
+    conn = get_db()
+    try:
+        rows = conn.execute("""
+            SELECT g.id, g.brand_name, g.topic, g.platform, g.tone, g.image_url, g.share_id, g.status, g.created_at,
+                   snippet(generations_fts, 2, ?1, ?2, '…', 16) AS script_snippet,
+                   snippet(generations_fts, 3, ?1, ?2, '…', 16) AS visual_prompt_snippet
+            FROM generations_fts JOIN generations g ON g.rowid = generations_fts.rowid
+            WHERE generations_fts MATCH ?3
+            ORDER BY bm25(generations_fts, 0.0, 2.0, 1.0, 0.5)
+            LIMIT ?4 OFFSET ?5
+        """, (SNIPPET_START, SNIPPET_END, build_search_query(user["user_id"], q), limit, offset)).fetchall()
+        items = []
+        for r in rows:
+            item = dict(r)
+            for key in ("script_snippet", "visual_prompt_snippet"):
+                item[key] = render_snippet(item[key])
+            items.append(item)
+        return {"items": items, "query": q}
     finally:
         conn.close()
 
@@ -567,16 +2146,29 @@ def get_generation(gen_id: str, user=Depends(get_current_user)):
     finally:
         conn.close()
 
-@app.delete("/history/{gen_id}")
-def delete_generation(gen_id: str, user=Depends(get_current_user)):
+@app.get("/history/{gen_id}/image")
+def get_generation_image(gen_id: str, user=Depends(get_current_user)):
+    """Poll target for an image_deferred reference: pending until the background fetch lands, fails
+    or runs past the image_deadline on the row (which also covers a worker process that died)"""
     conn = get_db()
     try:
-        conn.execute("DELETE FROM generations WHERE id = ? AND user_id = ?", (gen_id, user["user_id"]))
-        conn.commit()
-        return {"message": "Deleted"}
+        row = conn.execute(
+            "SELECT image_url, image_deadline > ? AS pending FROM generations WHERE id = ? AND user_id = ?",
+            (time.time(), gen_id, user["user_id"])
+        ).fetchone()
+        if not row:
+            raise HTTPException(status_code=404, detail="Generation not found")
+        if row["image_url"]:
+            return {"status": "ready", "image_url": row["image_url"]}
+        return {"status": "pending" if row["pending"] else "failed", "image_url": None}
     finally:
         conn.close()
 
+@app.delete("/history/{gen_id}")
+def delete_generation(gen_id: str, user=Depends(get_current_user)):
+    db_writer.run(lambda conn: conn.execute("DELETE FROM generations WHERE id = ? AND user_id = ?", (gen_id, user["user_id"])))
+    return {"message": "Deleted"}
+
 # ---------- SHARING ----------
 @app.get("/share/{share_id}")
 def get_shared(share_id: str):
@@ -593,45 +2185,126 @@ def get_shared(share_id: str):
 # ---------- ANALYTICS ----------
 @app.get("/analytics")
 def get_analytics(user=Depends(get_current_user)):
+    """Read from the generation rollups, so the cost doesn't grow with the size of the history"""
     conn = get_db()
     try:
         uid = user["user_id"]
-        total_gens = conn.execute("SELECT COUNT(*) FROM generations WHERE user_id = ?", (uid,)).fetchone()[0]
-        
-        # Generations per platform
-        platform_rows = conn.execute(
-            "SELECT platform, COUNT(*) as count FROM generations WHERE user_id = ? GROUP BY platform ORDER BY count DESC",
-            (uid,)
-        ).fetchall()
-        
-        # Generations per brand
-        brand_rows = conn.execute(
-            "SELECT brand_name, COUNT(*) as count FROM generations WHERE user_id = ? GROUP BY brand_name ORDER BY count DESC LIMIT 10",
+        # Generations per platform / brand / tone; a user has few enough rows to sort here rather
+        # than in a temp b-tree
+        totals = {"platform": [], "brand": [], "tone": []}
+        for r in conn.execute(
+            "SELECT dimension, value, generations FROM generation_rollup_totals WHERE user_id = ?",
             (uid,)
-        ).fetchall()
-        
+        ):
+            totals[r["dimension"]].append((r["value"], r["generations"]))
+        for rows in totals.values():
+            rows.sort(key=lambda vc: vc[1], reverse=True)
+
         # Generations over time (last 30 days)
         timeline = conn.execute(
-            "SELECT date(created_at) as day, COUNT(*) as count FROM generations WHERE user_id = ? AND created_at >= date('now', '-30 days') GROUP BY day ORDER BY day",
-            (uid,)
-        ).fetchall()
-        
-        # Generations by tone
-        tone_rows = conn.execute(
-            "SELECT tone, COUNT(*) as count FROM generations WHERE user_id = ? GROUP BY tone ORDER BY count DESC",
+            "SELECT day, generations as count FROM generation_rollup_daily WHERE user_id = ? AND day >= date('now', '-30 days') ORDER BY day",
             (uid,)
         ).fetchall()
         
         return {
-            "total_generations": total_gens,
-            "by_platform": [dict(r) for r in platform_rows],
-            "by_brand": [dict(r) for r in brand_rows],
+            "total_generations": sum(count for _, count in totals["platform"]),
+            "by_platform": [{"platform": v, "count": c} for v, c in totals["platform"]],
+            "by_brand": [{"brand_name": v, "count": c} for v, c in totals["brand"][:10]],
             "timeline": [dict(r) for r in timeline],
-            "by_tone": [dict(r) for r in tone_rows]
+            "by_tone": [{"tone": v, "count": c} for v, c in totals["tone"]]
         }
     finally:
         conn.close()
 
+# Raw analytics events are append-only. Past ANALYTICS_RETENTION_DAYS they are rolled into
+# analytics_hourly, and hourly buckets past ANALYTICS_HOURLY_DAYS into analytics_daily. Each batch
+# is one small db_writer unit, so request writes wait behind at most one batch.
+_analytics_compactor = None
+
+def compact_raw_events(conn, cutoff: str, limit: int) -> int:
+    """Unit of work: fold up to `limit` of the oldest raw events created before `cutoff` into hourly counts.
+    ids increase with created_at, so the oldest events are a bounded range at the front of the table."""
+    rows = conn.execute("SELECT id, created_at FROM analytics ORDER BY id LIMIT ?", (limit,)).fetchall()
+    old = list(itertools.takewhile(lambda r: r["created_at"] < cutoff, rows))
+    if not old:
+        return 0
+    last_id = old[-1]["id"]
+    conn.execute("""
+        INSERT INTO analytics_hourly (hour, user_id, action, events)
+        SELECT strftime('%Y-%m-%d %H:00:00', created_at), user_id, action, COUNT(*)
+        FROM analytics WHERE id <= ? GROUP BY 1, 2, 3
+        ON CONFLICT (hour, user_id, action) DO UPDATE SET events = events + excluded.events
+    """, (last_id,))
+    conn.execute("DELETE FROM analytics WHERE id <= ?", (last_id,))
+    return len(old)
+
+def compact_hourly_buckets(conn, cutoff: str, limit: int) -> int:
+    """Unit of work: fold up to `limit` hourly buckets older than `cutoff` into daily counts"""
+    rows = conn.execute("SELECT hour, user_id, action, events FROM analytics_hourly WHERE hour < ? LIMIT ?",
+                        (cutoff, limit)).fetchall()
+    conn.executemany("""
+        INSERT INTO analytics_daily (day, user_id, action, events) VALUES (date(?), ?, ?, ?)
+        ON CONFLICT (day, user_id, action) DO UPDATE SET events = events + excluded.events
+    """, [tuple(r) for r in rows])
+    conn.executemany("DELETE FROM analytics_hourly WHERE hour = ? AND user_id = ? AND action = ?",
+                     [(r["hour"], r["user_id"], r["action"]) for r in rows])
+    return len(rows)
+
+def incremental_vacuum(max_pages: int = 1024) -> int:
+    """Return up to max_pages free pages to the OS; a no-op unless auto_vacuum is INCREMENTAL"""
+    conn = get_db()
+    try:
+        free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        # executescript steps the pragma to completion; execute() would free a single page
+        conn.executescript(f"PRAGMA incremental_vacuum({int(max_pages)});")
+        return free - conn.execute("PRAGMA freelist_count").fetchone()[0]
+    finally:
+        conn.close()
+
+async def compact_analytics() -> dict:
+    """One compaction pass over both tiers, batch by batch"""
+    now = datetime.utcnow()
+    stats = {"raw_events": 0, "hourly_buckets": 0, "pages_freed": 0}
+    for key, unit, days in (("raw_events", compact_raw_events, ANALYTICS_RETENTION_DAYS),
+                            ("hourly_buckets", compact_hourly_buckets, ANALYTICS_HOURLY_DAYS)):
+        cutoff = (now - timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+        while True:
+            done = await db_writer.run_async(lambda conn: unit(conn, cutoff, ANALYTICS_COMPACT_BATCH))
+            stats[key] += done
+            if done < ANALYTICS_COMPACT_BATCH:
+                break
+            await asyncio.sleep(0.01)  # let queued request writes through between batches
+    while True:
+        freed = await asyncio.to_thread(incremental_vacuum)
+        stats["pages_freed"] += freed
+        if freed <= 0:
+            break
+        await asyncio.sleep(0.01)
+    return stats
+
+async def analytics_compactor():
+    while True:
+        try:
+            stats = await compact_analytics()
+            if stats["raw_events"] or stats["hourly_buckets"]:
+                print(f"Compacted analytics: {stats}")
+        except Exception as e:
+            print(f"Analytics compaction failed: {e}")
+        await asyncio.sleep(ANALYTICS_COMPACT_INTERVAL)
+
+@app.on_event("startup")
+async def start_analytics_compactor():
+    global _analytics_compactor
+    if ANALYTICS_RETENTION_DAYS > 0:
+        _analytics_compactor = asyncio.create_task(analytics_compactor())
+
+async def stop_analytics_compactor():
+    global _analytics_compactor
+    if _analytics_compactor is not None:
+        _analytics_compactor.cancel()
+        await asyncio.gather(_analytics_compactor, return_exceptions=True)
+        _analytics_compactor = None
+
 # ---------- TEMPLATES ----------
 @app.get("/templates")
 def get_templates():
@@ -905,49 +2578,150 @@ def get_campaign_frameworks():
     return CAMPAIGN_FRAMEWORKS
 
 @app.get("/campaigns")
-def list_campaigns(user=Depends(get_current_user)):
-    conn = get_db()
-    try:
-        rows = conn.execute("SELECT * FROM campaigns WHERE user_id = ? ORDER BY created_at DESC", (user["user_id"],)).fetchall()
-        return [dict(r) for r in rows]
-    finally:
-        conn.close()
+def list_campaigns(request: Request, user=Depends(get_current_user)):
+    def build():
+        conn = get_db()
+        try:
+            rows = conn.execute("SELECT * FROM campaigns WHERE user_id = ? ORDER BY created_at DESC", (user["user_id"],)).fetchall()
+            return [dict(r) for r in rows]
+        finally:
+            conn.close()
+    return cached_user_response(request, user["user_id"], build)
 
 @app.post("/campaigns")
 def create_campaign(campaign: CampaignCreate, user=Depends(get_current_user)):
-    conn = get_db()
-    try:
-        cid = str(uuid.uuid4())
+    cid = str(uuid.uuid4())
+
+    def write(conn):
         conn.execute(
             "INSERT INTO campaigns (id, user_id, name, description, brand_name, start_date, end_date, template_type, posts_data) VALUES (?,?,?,?,?,?,?,?,?)",
             (cid, user["user_id"], campaign.name, campaign.description, campaign.brand_name, campaign.start_date, campaign.end_date, campaign.template_type, campaign.posts_data)
         )
-        conn.commit()
         award_xp(conn, user["user_id"], 50, "campaign_created")
-        return {"id": cid, "message": "Campaign created"}
-    finally:
-        conn.close()
+    db_writer.run(write)
+    return {"id": cid, "message": "Campaign created"}
 
 @app.put("/campaigns/{cid}")
 def update_campaign(cid: str, campaign: CampaignCreate, user=Depends(get_current_user)):
+    db_writer.run(lambda conn: conn.execute(
+        "UPDATE campaigns SET name=?, description=?, brand_name=?, start_date=?, end_date=?, template_type=?, posts_data=?, status='active' WHERE id=? AND user_id=?",
+        (campaign.name, campaign.description, campaign.brand_name, campaign.start_date, campaign.end_date, campaign.template_type, campaign.posts_data, cid, user["user_id"])
+    ))
+    return {"message": "Campaign updated"}
+
+@app.delete("/campaigns/{cid}")
+def delete_campaign(cid: str, user=Depends(get_current_user)):
+    db_writer.run(lambda conn: conn.execute("DELETE FROM campaigns WHERE id=? AND user_id=?", (cid, user["user_id"])))
+    return {"message": "Campaign deleted"}
+
+class CampaignGenerateRequest(BaseModel):
+    topic: Optional[str] = None  # defaults to the campaign description, then its name
+    objective: Optional[str] = "Engagement"
+    target_audience: Optional[str] = "General"
+    platform: Optional[str] = "Instagram"
+    tone: Optional[str] = "Modern"
+    art_style: Optional[str] = "Photorealistic"
+    level: int = 2
+
+def campaign_post_dates(start_date: str, posts: list) -> List[str]:
+    """Frameworks that count from day 1 start on start_date; ones with a day 0 are anchored on it
+    (festival_week: day -3 is three days before the festival)"""
+    start = datetime.strptime(start_date, "%Y-%m-%d") if start_date else datetime.utcnow()
+    shift = 1 if posts and min(p.get("day", 1) for p in posts) >= 1 else 0
+    return [(start + timedelta(days=p.get("day", 1) - shift)).strftime("%Y-%m-%d") for p in posts]
+
+async def run_campaign_post_job(job: dict) -> dict:
+    spec = json.loads(job["request"])
+    req = GenerateRequest(**spec["generate"])
+    return await run_generation(
+        req, job["user_id"],
+        on_stage=job_stage_reporter(job["id"]),
+        row_extras={"campaign_id": spec["campaign_id"], "scheduled_date": spec["scheduled_date"], "status": "scheduled"},
+    )
+
+JOB_HANDLERS["campaign_post"] = run_campaign_post_job
+
+@app.post("/campaigns/{cid}/generate")
+def generate_campaign_posts(cid: str, body: CampaignGenerateRequest, user=Depends(get_current_user)):
+    """Queue one generation job per framework post; they run in parallel up to JOB_USER_CONCURRENCY.
+    Poll /campaigns/{cid}/generate/{batch_id} for per-post progress."""
+    check_rate_limit(user["user_id"], max_calls=5, window_seconds=60)
+    if not GENAI_KEY:
+        raise HTTPException(status_code=500, detail="Gemini API key not configured")
     conn = get_db()
     try:
-        conn.execute(
-            "UPDATE campaigns SET name=?, description=?, brand_name=?, start_date=?, end_date=?, template_type=?, posts_data=?, status='active' WHERE id=? AND user_id=?",
-            (campaign.name, campaign.description, campaign.brand_name, campaign.start_date, campaign.end_date, campaign.template_type, campaign.posts_data, cid, user["user_id"])
-        )
-        conn.commit()
-        return {"message": "Campaign updated"}
+        campaign = conn.execute("SELECT * FROM campaigns WHERE id=? AND user_id=?", (cid, user["user_id"])).fetchone()
+        if not campaign:
+            raise HTTPException(status_code=404, detail="Campaign not found")
+        try:
+            posts = json.loads(campaign["posts_data"] or "[]")
+        except json.JSONDecodeError:
+            posts = []
+        if not isinstance(posts, list) or not all(isinstance(p, dict) and isinstance(p.get("day", 1), int) for p in posts):
+            raise HTTPException(status_code=400, detail='Campaign posts_data must be a JSON list of posts like {"day": 1, "type": "Teaser"}')
+        if not posts:
+            posts = CAMPAIGN_FRAMEWORKS.get(campaign["template_type"], {}).get("posts", [])
+        if not posts:
+            raise HTTPException(status_code=400, detail="Campaign has no framework posts to generate")
+        try:
+            dates = campaign_post_dates(campaign["start_date"], posts)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Campaign start_date must be YYYY-MM-DD")
+
+        topic = body.topic or campaign["description"] or campaign["name"]
+        batch_id = str(uuid.uuid4())
+        specs = []
+        for post, scheduled_date in zip(posts, dates):
+            req = GenerateRequest(
+                brand_name=campaign["brand_name"] or campaign["name"],
+                topic=f"{topic} - {post.get('type', 'Post')}: {post.get('prompt_hint', '')}",
+                objective=body.objective, target_audience=body.target_audience, platform=body.platform,
+                tone=body.tone, art_style=body.art_style, level=body.level,
+            )
+            specs.append({"generate": req.dict(), "campaign_id": cid, "scheduled_date": scheduled_date,
+                          "post_type": post.get("type", ""), "day": post.get("day")})
     finally:
         conn.close()
 
-@app.delete("/campaigns/{cid}")
-def delete_campaign(cid: str, user=Depends(get_current_user)):
+    job_ids = db_writer.run(lambda conn: [enqueue_job(conn, user["user_id"], "campaign_post", spec, batch_id=batch_id) for spec in specs])
+    notify_job_workers()
+    jobs = [{"job_id": job_id, "post_type": spec["post_type"], "day": spec["day"], "scheduled_date": spec["scheduled_date"]}
+            for job_id, spec in zip(job_ids, specs)]
+    return {"batch_id": batch_id, "total": len(jobs), "posts": jobs}
+
+@app.get("/campaigns/{cid}/generate/{batch_id}")
+def get_campaign_generation(cid: str, batch_id: str, user=Depends(get_current_user)):
     conn = get_db()
     try:
-        conn.execute("DELETE FROM campaigns WHERE id=? AND user_id=?", (cid, user["user_id"]))
-        conn.commit()
-        return {"message": "Campaign deleted"}
+        rows = conn.execute(
+            "SELECT id, status, stage, request, result, error FROM jobs WHERE batch_id = ? AND user_id = ? ORDER BY created_at, rowid",
+            (batch_id, user["user_id"])
+        ).fetchall()
+        posts = []
+        for r in rows:
+            spec = json.loads(r["request"])
+            if spec.get("campaign_id") != cid:
+                continue
+            result = json.loads(r["result"]) if r["result"] else None
+            posts.append({
+                "job_id": r["id"],
+                "post_type": spec.get("post_type", ""),
+                "day": spec.get("day"),
+                "scheduled_date": spec["scheduled_date"],
+                "status": r["status"],
+                "stage": r["stage"],
+                "generation_id": result.get("id") if result else None,
+                "error": r["error"] or None,
+            })
+        if not posts:
+            raise HTTPException(status_code=404, detail="Campaign generation not found")
+        return {
+            "batch_id": batch_id,
+            "total": len(posts),
+            "done": sum(1 for p in posts if p["status"] == "done"),
+            "failed": sum(1 for p in posts if p["status"] == "failed"),
+            "posts": posts,
+        }
     finally:
         conn.close()
 
@@ -958,83 +2732,69 @@ class SchedulePost(BaseModel):
 
 @app.post("/schedule")
 def schedule_post(req: SchedulePost, user=Depends(get_current_user)):
-    conn = get_db()
-    try:
-        conn.execute("UPDATE generations SET scheduled_date=?, status='scheduled' WHERE id=? AND user_id=?",
-                      (req.scheduled_date, req.generation_id, user["user_id"]))
-        conn.commit()
-        return {"message": "Post scheduled"}
-    finally:
-        conn.close()
+    db_writer.run(lambda conn: conn.execute("UPDATE generations SET scheduled_date=?, status='scheduled' WHERE id=? AND user_id=?",
+                                            (req.scheduled_date, req.generation_id, user["user_id"])))
+    return {"message": "Post scheduled"}
 
 @app.get("/scheduled")
-def get_scheduled(user=Depends(get_current_user)):
-    conn = get_db()
-    try:
-        rows = conn.execute(
-            "SELECT * FROM generations WHERE user_id=? AND scheduled_date != '' ORDER BY scheduled_date ASC",
-            (user["user_id"],)
-        ).fetchall()
-        return [dict(r) for r in rows]
-    finally:
-        conn.close()
+def get_scheduled(request: Request, user=Depends(get_current_user), fields: str = None):
+    select_sql, _ = project_fields(fields, GENERATION_COLUMNS, GENERATION_SUMMARY)
+    def build():
+        conn = get_db()
+        try:
+            rows = conn.execute(
+                f"SELECT {select_sql} FROM generations WHERE user_id=? AND scheduled_date != '' ORDER BY scheduled_date ASC",
+                (user["user_id"],)
+            ).fetchall()
+            return [dict(r) for r in rows]
+        finally:
+            conn.close()
+    return cached_user_response(request, user["user_id"], build)
 
 @app.delete("/schedule/{gen_id}")
 def unschedule_post(gen_id: str, user=Depends(get_current_user)):
-    conn = get_db()
-    try:
-        conn.execute("UPDATE generations SET scheduled_date='', status='published' WHERE id=? AND user_id=?",
-                      (gen_id, user["user_id"]))
-        conn.commit()
-        return {"message": "Unscheduled"}
-    finally:
-        conn.close()
+    db_writer.run(lambda conn: conn.execute("UPDATE generations SET scheduled_date='', status='published' WHERE id=? AND user_id=?",
+                                            (gen_id, user["user_id"])))
+    return {"message": "Unscheduled"}
 
 # ---------- EVERGREEN CONTENT QUEUE ----------
 @app.post("/evergreen/{gen_id}")
 def mark_evergreen(gen_id: str, recycle_days: int = 30, user=Depends(get_current_user)):
-    conn = get_db()
-    try:
-        conn.execute("UPDATE generations SET is_evergreen=1, recycle_days=? WHERE id=? AND user_id=?",
-                      (recycle_days, gen_id, user["user_id"]))
-        conn.commit()
-        return {"message": "Marked as evergreen"}
-    finally:
-        conn.close()
+    db_writer.run(lambda conn: conn.execute("UPDATE generations SET is_evergreen=1, recycle_days=? WHERE id=? AND user_id=?",
+                                            (recycle_days, gen_id, user["user_id"])))
+    return {"message": "Marked as evergreen"}
 
 @app.delete("/evergreen/{gen_id}")
 def remove_evergreen(gen_id: str, user=Depends(get_current_user)):
-    conn = get_db()
-    try:
-        conn.execute("UPDATE generations SET is_evergreen=0, recycle_days=0 WHERE id=? AND user_id=?",
-                      (gen_id, user["user_id"]))
-        conn.commit()
-        return {"message": "Removed from evergreen"}
-    finally:
-        conn.close()
+    db_writer.run(lambda conn: conn.execute("UPDATE generations SET is_evergreen=0, recycle_days=0 WHERE id=? AND user_id=?",
+                                            (gen_id, user["user_id"])))
+    return {"message": "Removed from evergreen"}
 
 @app.get("/evergreen")
-def get_evergreen_queue(user=Depends(get_current_user)):
-    conn = get_db()
-    try:
-        rows = conn.execute(
-            "SELECT * FROM generations WHERE user_id=? AND is_evergreen=1 ORDER BY created_at DESC",
-            (user["user_id"],)
-        ).fetchall()
-        items = []
-        for r in rows:
-            d = dict(r)
-            created = datetime.fromisoformat(d["created_at"]) if d["created_at"] else datetime.utcnow()
-            recycle = d.get("recycle_days", 30) or 30
-            next_date = created + timedelta(days=recycle)
-            while next_date < datetime.utcnow():
-                next_date += timedelta(days=recycle)
-            d["next_recycle"] = next_date.isoformat()
-            d["days_until_recycle"] = (next_date - datetime.utcnow()).days
-            items.append(d)
-        return items
-    finally:
-        conn.close()
+def get_evergreen_queue(request: Request, user=Depends(get_current_user), fields: str = None):
+    select_sql, names = project_fields(fields, GENERATION_COLUMNS, GENERATION_SUMMARY, required=("created_at", "recycle_days"))
+    def build():
+        conn = get_db()
+        try:
+            rows = conn.execute(
+                f"SELECT {select_sql} FROM generations WHERE user_id=? AND is_evergreen=1 ORDER BY created_at DESC",
+                (user["user_id"],)
+            ).fetchall()
+            items = []
+            for r in rows:
+                d = dict(r)
+                created = datetime.fromisoformat(d["created_at"]) if d["created_at"] else datetime.utcnow()
+                recycle = d.get("recycle_days", 30) or 30
+                next_date = created + timedelta(days=recycle)
+                while next_date < datetime.utcnow():
+                    next_date += timedelta(days=recycle)
+                d["next_recycle"] = next_date.isoformat()
+                d["days_until_recycle"] = (next_date - datetime.utcnow()).days
+                items.append(trim_row(d, names, extra=("next_recycle", "days_until_recycle")))
+            return items
+        finally:
+            conn.close()
+    return cached_user_response(request, user["user_id"], build)
 
 # ---------- CONTENT SCORING (Zero AI) ----------
 @app.post("/analyze/engagement")
@@ -1356,24 +3116,21 @@ class ApprovalReview(BaseModel):
 
 @app.post("/approvals/submit")
 def submit_for_approval(req: ApprovalSubmit, user=Depends(get_current_user)):
-    conn = get_db()
-    try:
-        aid = str(uuid.uuid4())
+    aid = str(uuid.uuid4())
+
+    def write(conn):
         conn.execute(
             "INSERT INTO approvals (id, generation_id, user_id, status, submitted_at) VALUES (?,?,?,?,?)",
             (aid, req.generation_id, user["user_id"], "pending", datetime.utcnow().isoformat())
         )
         conn.execute("UPDATE generations SET status='in_review' WHERE id=? AND user_id=?",
                       (req.generation_id, user["user_id"]))
-        conn.commit()
-        return {"id": aid, "message": "Submitted for review"}
-    finally:
-        conn.close()
+    db_writer.run(write)
+    return {"id": aid, "message": "Submitted for review"}
 
 @app.put("/approvals/{approval_id}")
 def review_approval(approval_id: str, review: ApprovalReview, user=Depends(get_current_user)):
-    conn = get_db()
-    try:
+    def write(conn):
         conn.execute(
             "UPDATE approvals SET status=?, reviewer_notes=?, reviewed_at=? WHERE id=? AND user_id=?",
             (review.status, review.reviewer_notes, datetime.utcnow().isoformat(), approval_id, user["user_id"])
@@ -1383,23 +3140,24 @@ def review_approval(approval_id: str, review: ApprovalReview, user=Depends(get_c
         if approval:
             new_status = "approved" if review.status == "approved" else "draft" if review.status == "rejected" else "revision_needed"
             conn.execute("UPDATE generations SET status=? WHERE id=?", (new_status, approval["generation_id"]))
-        conn.commit()
-        return {"message": f"Content {review.status}"}
-    finally:
-        conn.close()
+    db_writer.run(write)
+    return {"message": f"Content {review.status}"}
 
 @app.get("/approvals")
-def list_approvals(user=Depends(get_current_user)):
-    conn = get_db()
-    try:
-        rows = conn.execute("""
-            SELECT a.*, g.script, g.brand_name, g.platform, g.image_url 
-            FROM approvals a JOIN generations g ON a.generation_id = g.id 
-            WHERE a.user_id=? ORDER BY a.created_at DESC
-        """, (user["user_id"],)).fetchall()
-        return [dict(r) for r in rows]
-    finally:
-        conn.close()
+def list_approvals(request: Request, user=Depends(get_current_user), fields: str = None):
+    select_sql, _ = project_fields(fields, APPROVAL_COLUMNS, APPROVAL_SUMMARY)
+    def build():
+        conn = get_db()
+        try:
+            rows = conn.execute(f"""
+                SELECT {select_sql}
+                FROM approvals a JOIN generations g ON a.generation_id = g.id 
+                WHERE a.user_id=? ORDER BY a.created_at DESC
+            """, (user["user_id"],)).fetchall()
+            return [dict(r) for r in rows]
+        finally:
+            conn.close()
+    return cached_user_response(request, user["user_id"], build)
 
 # ---------- GAMIFICATION ----------
 BADGE_DEFINITIONS = [
@@ -1416,7 +3174,7 @@ BADGE_DEFINITIONS = [
 ]
 
 def award_xp(conn, user_id: str, xp_amount: int, action: str):
-    """Award XP and update streak"""
+    """Award XP and update streak; part of the caller's unit of work"""
     today = datetime.utcnow().strftime("%Y-%m-%d")
     user = conn.execute("SELECT xp, streak_current, streak_best, streak_last_date FROM users WHERE id=?", (user_id,)).fetchone()
     if not user:
@@ -1445,92 +3203,143 @@ def award_xp(conn, user_id: str, xp_amount: int, action: str):
         "UPDATE users SET xp=?, level=?, streak_current=?, streak_best=?, streak_last_date=? WHERE id=?",
         (current_xp, level, streak, best_streak, today, user_id)
     )
-    conn.commit()
+    check_badges(conn, user_id)
 
 def check_badges(conn, user_id: str):
-    """Check and award new badges"""
-    user = conn.execute("SELECT xp, badges FROM users WHERE id=?", (user_id,)).fetchone()
+    """Award badges the user now qualifies for, from the counters on their users row. Called by the
+    writes that can move a counter, XP or streak, as part of their unit of work; new badges also
+    wait in badges_unseen until POST /gamification/seen acknowledges them"""
+    user = conn.execute(
+        "SELECT xp, streak_current, badges, badges_unseen, generation_count, brand_count, campaign_count, platform_count FROM users WHERE id=?",
+        (user_id,)
+    ).fetchone()
     if not user:
         return []
     
     current_badges = json.loads(user["badges"] or "[]")
     current_badge_ids = {b["id"] for b in current_badges} if isinstance(current_badges, list) and current_badges and isinstance(current_badges[0], dict) else set(current_badges)
     
-    # Get stats
-    gen_count = conn.execute("SELECT COUNT(*) FROM generations WHERE user_id=?", (user_id,)).fetchone()[0]
-    brand_count = conn.execute("SELECT COUNT(*) FROM brands WHERE user_id=?", (user_id,)).fetchone()[0]
-    campaign_count = conn.execute("SELECT COUNT(*) FROM campaigns WHERE user_id=?", (user_id,)).fetchone()[0]
-    platform_count = conn.execute("SELECT COUNT(DISTINCT platform) FROM generations WHERE user_id=?", (user_id,)).fetchone()[0]
-    streak = user["xp"] and conn.execute("SELECT streak_current FROM users WHERE id=?", (user_id,)).fetchone()["streak_current"] or 0
+    stats = {
+        "generations": user["generation_count"] or 0,
+        "streak": user["streak_current"] or 0,
+        "brands": user["brand_count"] or 0,
+        "campaigns": user["campaign_count"] or 0,
+        "platforms": user["platform_count"] or 0,
+    }
     
     new_badges = []
     for badge in BADGE_DEFINITIONS:
         if badge["id"] in current_badge_ids:
             continue
         
-        earned = False
         if badge.get("xp_threshold", 0) > 0:
             earned = (user["xp"] or 0) >= badge["xp_threshold"]
-        elif "generations >= " in badge.get("condition", ""):
-            threshold = int(badge["condition"].split(">= ")[1])
-            earned = gen_count >= threshold
-        elif "streak >= " in badge.get("condition", ""):
-            threshold = int(badge["condition"].split(">= ")[1])
-            earned = streak >= threshold
-        elif "brands >= " in badge.get("condition", ""):
-            threshold = int(badge["condition"].split(">= ")[1])
-            earned = brand_count >= threshold
-        elif "campaigns >= " in badge.get("condition", ""):
-            threshold = int(badge["condition"].split(">= ")[1])
-            earned = campaign_count >= threshold
-        elif "platforms >= " in badge.get("condition", ""):
-            threshold = int(badge["condition"].split(">= ")[1])
-            earned = platform_count >= threshold
+        else:
+            stat, _, threshold = badge.get("condition", "").partition(" >= ")
+            earned = stat in stats and stats[stat] >= int(threshold)
         
         if earned:
             new_badges.append(badge)
     
     if new_badges:
-        all_badges = list(current_badge_ids) + [b["id"] for b in new_badges]
-        conn.execute("UPDATE users SET badges=? WHERE id=?", (json.dumps(all_badges), user_id))
-        conn.commit()
+        new_ids = [b["id"] for b in new_badges]
+        all_badges = list(current_badge_ids) + new_ids
+        unseen = json.loads(user["badges_unseen"] or "[]") + new_ids
+        conn.execute("UPDATE users SET badges=?, badges_unseen=? WHERE id=?", (json.dumps(all_badges), json.dumps(unseen), user_id))
     
     return new_badges
 
+def recount_gamification_counters(conn, user_id: str) -> bool:
+    """Recount one user's counters from the source tables, repair them if they drifted and award
+    badges they now qualify for, without committing. Returns whether anything was repaired"""
+    row = conn.execute("""
+        SELECT generation_count, brand_count, campaign_count, platform_count,
+            (SELECT COUNT(*) FROM generations WHERE user_id = u.id),
+            (SELECT COUNT(*) FROM brands WHERE user_id = u.id),
+            (SELECT COUNT(*) FROM campaigns WHERE user_id = u.id),
+            (SELECT COUNT(DISTINCT platform) FROM generations WHERE user_id = u.id AND platform != '')
+        FROM users u WHERE id = ?
+    """, (user_id,)).fetchone()
+    if row is None:
+        return False
+    stored, actual = tuple(row)[:4], tuple(row)[4:]
+    if stored != actual:
+        conn.execute("UPDATE users SET generation_count=?, brand_count=?, campaign_count=?, platform_count=? WHERE id=?",
+                     (*actual, user_id))
+    check_badges(conn, user_id)
+    return stored != actual
+
+def check_gamification_counters(conn) -> int:
+    """recount_gamification_counters for every user, one short transaction each, so it can run next
+    to the server. Returns the number of users repaired"""
+    repaired = 0
+    user_ids = [r[0] for r in conn.execute("SELECT id FROM users").fetchall()]
+    for user_id in user_ids:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            repaired += recount_gamification_counters(conn, user_id)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return repaired
+
 @app.get("/gamification")
-def get_gamification(user=Depends(get_current_user)):
-    conn = get_db()
-    try:
-        uid = user["user_id"]
-        u = conn.execute("SELECT xp, level, streak_current, streak_best, badges FROM users WHERE id=?", (uid,)).fetchone()
-        if not u:
-            return {"xp": 0, "level": 1, "streak": 0}
+def get_gamification(request: Request, user=Depends(get_current_user)):
+    def build():
+        conn = get_db()
+        try:
+            uid = user["user_id"]
+            u = conn.execute(
+                "SELECT xp, level, streak_current, streak_best, badges, badges_unseen, generation_count FROM users WHERE id=?",
+                (uid,)
+            ).fetchone()
+            if not u:
+                return {"xp": 0, "level": 1, "streak": 0}
         
-        # Check for new badges
-        new_badges = check_badges(conn, uid)
+            # Badges are awarded by the writes that earn them; new_badges lists them until the client
+            # acknowledges them with POST /gamification/seen
+            unseen = json.loads(u["badges_unseen"] or "[]")
+            new_badges = [b for b in BADGE_DEFINITIONS if b["id"] in unseen]
         
-        xp = u["xp"] or 0
-        level = u["level"] or 1
-        next_level_xp = level * 100
+            xp = u["xp"] or 0
+            level = u["level"] or 1
+            next_level_xp = level * 100
         
-        earned_ids = set(json.loads(u["badges"] or "[]"))
-        all_badges = []
-        for b in BADGE_DEFINITIONS:
-            all_badges.append({**b, "earned": b["id"] in earned_ids})
+            earned_ids = set(json.loads(u["badges"] or "[]"))
+            all_badges = []
+            for b in BADGE_DEFINITIONS:
+                all_badges.append({**b, "earned": b["id"] in earned_ids})
         
-        return {
-            "xp": xp,
-            "level": level,
-            "xp_to_next_level": next_level_xp - xp,
-            "next_level_xp": next_level_xp,
-            "streak_current": u["streak_current"] or 0,
-            "streak_best": u["streak_best"] or 0,
-            "badges": all_badges,
-            "new_badges": new_badges,
-            "gen_count": conn.execute("SELECT COUNT(*) FROM generations WHERE user_id=?", (uid,)).fetchone()[0],
-        }
-    finally:
-        conn.close()
+            return {
+                "xp": xp,
+                "level": level,
+                "xp_to_next_level": next_level_xp - xp,
+                "next_level_xp": next_level_xp,
+                "streak_current": u["streak_current"] or 0,
+                "streak_best": u["streak_best"] or 0,
+                "badges": all_badges,
+                "new_badges": new_badges,
+                "gen_count": u["generation_count"] or 0,
+            }
+        finally:
+            conn.close()
+    return cached_user_response(request, user["user_id"], build)
+
+class BadgesSeen(BaseModel):
+    badges: List[str]
+
+@app.post("/gamification/seen")
+def mark_badges_seen(req: BadgesSeen, user=Depends(get_current_user)):
+    """Drop the badges the client has shown from new_badges; any awarded since stay listed"""
+    def write(conn):
+        row = conn.execute("SELECT badges_unseen FROM users WHERE id=?", (user["user_id"],)).fetchone()
+        unseen = json.loads(row["badges_unseen"] or "[]") if row else []
+        remaining = [b for b in unseen if b not in req.badges]
+        if remaining != unseen:
+            conn.execute("UPDATE users SET badges_unseen=? WHERE id=?", (json.dumps(remaining), user["user_id"]))
+    db_writer.run(write)
+    return {"message": "Badges marked as seen"}
 
 # ---------- INSPIRATION FEED ----------
 @app.get("/inspiration")
@@ -1567,3 +3376,30 @@ def get_inspiration_feed():
 @app.get("/")
 def read_root():
     return {"message": "Content Studio AI Backend is Running", "version": "3.0"}
+
+if __name__ == "__main__":
+    import sys
+    command = sys.argv[1:]
+    if command == ["rebuild-analytics"]:
+        # python main.py rebuild-analytics: recompute the /analytics rollups from generations
+        init_db()
+        conn = get_db()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            execute_statements(conn, GENERATION_ROLLUP_REBUILD)
+            conn.commit()
+            days, totals = (conn.execute(f"SELECT COUNT(*) FROM {t}").fetchone()[0]
+                            for t in ("generation_rollup_daily", "generation_rollup_totals"))
+            print(f"Rebuilt generation rollups: {days} daily rows, {totals} total rows")
+        finally:
+            conn.close()
+    elif command == ["check-counters"]:
+        # python main.py check-counters: recount the gamification counters and repair any drift
+        init_db()
+        conn = get_db()
+        try:
+            print(f"Checked gamification counters: {check_gamification_counters(conn)} users repaired")
+        finally:
+            conn.close()
+    else:
+        print("usage: python main.py rebuild-analytics | check-counters")
@@ -0,0 +1,43 @@
+import os
+import sys
+import uuid
+
+import pytest
+from fastapi.testclient import TestClient
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("GEMINI_API_KEY", "test")
+
+import main as app_main  # noqa: E402
+
+
+@pytest.fixture
+def main(tmp_path):
+    """The backend module on a fresh, fully migrated database"""
+    app_main.DATABASE_PATH = str(tmp_path / "test.db")
+    app_main._db_pool = None
+    app_main.init_db()
+    yield app_main
+    app_main.db_writer.stop()
+    app_main._db_pool.close_all()
+    app_main._db_pool = None
+
+
+@pytest.fixture
+def make_user(main):
+    def make(email=None):
+        user_id = str(uuid.uuid4())
+        main.db_writer.run(lambda conn: conn.execute(
+            "INSERT INTO users (id, username, email, password_hash) VALUES (?, ?, ?, ?)",
+            (user_id, "test", email or f"{user_id}@example.com", "x")))
+        return user_id
+    return make
+
+
+@pytest.fixture
+def client(main, make_user):
+    """A TestClient signed in as a fresh user; returns (client, user_id)"""
+    user_id = make_user()
+    main.app.dependency_overrides[main.get_current_user] = lambda: {"user_id": user_id}
+    yield TestClient(main.app), user_id
+    main.app.dependency_overrides.clear()
@@ -0,0 +1,38 @@
+import asyncio
+
+import httpx
+
+
+class FakeUpstream:
+    """An image host that serves `capacity` concurrent requests, each taking `latency` seconds.
+    Requests beyond that are refused the way a real host sheds load: a 429 straight away
+    (overload="429") or a timeout after `timeout` seconds (overload="timeout").
+    capacity can be changed while requests are running."""
+    def __init__(self, capacity: int, latency: float = 0.01, overload: str = "429", timeout: float = 0.05):
+        self.capacity = capacity
+        self.latency = latency
+        self.overload = overload
+        self.timeout = timeout
+        self.in_flight = 0
+        self.peak = 0
+        self.served = 0
+        self.refused = 0
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        if self.in_flight >= self.capacity:
+            self.refused += 1
+            if self.overload == "timeout":
+                await asyncio.sleep(self.timeout)
+                raise httpx.ReadTimeout("fake upstream overloaded", request=request)
+            return httpx.Response(429)
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency)
+        finally:
+            self.in_flight -= 1
+        self.served += 1
+        return httpx.Response(200, content=b"image")
+
+    def client(self, base_url: str) -> httpx.AsyncClient:
+        return httpx.AsyncClient(base_url=base_url, transport=httpx.MockTransport(self.handle))
@@ -0,0 +1,28 @@
+import pytest
+
+
+def create_campaign(http, posts_data):
+    r = http.post("/campaigns", json={"name": "Launch", "start_date": "2026-11-01", "posts_data": posts_data})
+    assert r.status_code == 200, r.text
+    return r.json()["id"]
+
+
+@pytest.mark.parametrize("posts_data", ['{"a": 1}', "[1, 2]", '[{"day": "three"}]', '"posts"'])
+def test_misshapen_posts_data_is_a_400(client, posts_data):
+    http, _ = client
+    cid = create_campaign(http, posts_data)
+
+    r = http.post(f"/campaigns/{cid}/generate", json={})
+
+    assert r.status_code == 400
+    assert "posts_data" in r.json()["detail"]
+
+
+def test_posts_data_schedules_from_the_start_date(client):
+    http, _ = client
+    cid = create_campaign(http, '[{"day": 1, "type": "Teaser"}, {"day": 3, "type": "Launch"}]')
+
+    r = http.post(f"/campaigns/{cid}/generate", json={})
+
+    assert r.status_code == 200, r.text
+    assert [(p["post_type"], p["scheduled_date"]) for p in r.json()["posts"]] == [("Teaser", "2026-11-01"), ("Launch", "2026-11-03")]
@@ -0,0 +1,19 @@
+import threading
+
+
+def test_a_cancelled_unit_is_skipped_and_the_writer_keeps_going(main, make_user):
+    user_id = make_user()
+    started, release = threading.Event(), threading.Event()
+
+    def blocker(conn):
+        started.set()
+        release.wait(5)
+
+    main.db_writer.submit(blocker)
+    started.wait(5)
+    # queued behind the blocker, then abandoned by its caller (e.g. a client that hung up)
+    abandoned = main.db_writer.submit(lambda conn: conn.execute("UPDATE users SET username = 'abandoned' WHERE id = ?", (user_id,)))
+    assert abandoned.cancel()
+    release.set()
+
+    assert main.db_writer.run(lambda conn: conn.execute("SELECT username FROM users WHERE id = ?", (user_id,)).fetchone()[0]) == "test"
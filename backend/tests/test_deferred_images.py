@@ -0,0 +1,52 @@
+import asyncio
+import time
+import uuid
+
+
+def add_generation(main, user_id, image_deadline):
+    gen_id = str(uuid.uuid4())
+    main.db_writer.run(lambda conn: conn.execute(
+        "INSERT INTO generations (id, user_id, image_deadline) VALUES (?, ?, ?)", (gen_id, user_id, image_deadline)))
+    return gen_id
+
+
+def image_status(http, gen_id):
+    r = http.get(f"/history/{gen_id}/image")
+    assert r.status_code == 200, r.text
+    return r.json()
+
+
+def test_status_follows_the_deadline_on_the_row(main, client):
+    http, user_id = client
+    # deferred by another worker process, so there is no background task in this one
+    in_time = add_generation(main, user_id, time.time() + 60)
+    overdue = add_generation(main, user_id, time.time() - 1)
+
+    assert image_status(http, in_time)["status"] == "pending"
+    assert image_status(http, overdue)["status"] == "failed"
+
+
+def test_background_fetch_settles_the_row(main, client):
+    http, user_id = client
+
+    async def fetch(image_url, seconds=0.0):
+        await asyncio.sleep(seconds)
+        return 0, image_url
+
+    async def scenario():
+        deadline = time.time() + 60
+        ready = add_generation(main, user_id, deadline)
+        failed = add_generation(main, user_id, deadline)
+        stuck = add_generation(main, user_id, time.time() + 0.2)
+        main.defer_image(ready, asyncio.ensure_future(fetch("/images/abc")), deadline)
+        main.defer_image(failed, asyncio.ensure_future(fetch(None)), deadline)
+        main.defer_image(stuck, asyncio.ensure_future(fetch("/images/late", seconds=5)), time.time() + 0.2)
+        await asyncio.gather(*list(main._deferred_images.values()))
+        return ready, failed, stuck
+
+    ready, failed, stuck = asyncio.run(scenario())
+
+    assert image_status(http, ready) == {"status": "ready", "image_url": "/images/abc"}
+    # a fetch that gave up is reported straight away, not once the deadline passes
+    assert image_status(http, failed)["status"] == "failed"
+    assert image_status(http, stuck)["status"] == "failed"
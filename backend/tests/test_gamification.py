@@ -0,0 +1,77 @@
+import json
+import uuid
+
+
+def add_generation(main, user_id, platform):
+    def write(conn):
+        conn.execute("INSERT INTO generations (id, user_id, platform) VALUES (?, ?, ?)",
+                     (str(uuid.uuid4()), user_id, platform))
+        main.check_badges(conn, user_id)
+    main.db_writer.run(write)
+
+
+def counters(main, user_id):
+    conn = main.get_db()
+    try:
+        return dict(conn.execute("SELECT platform_count, badges_unseen FROM users WHERE id = ?", (user_id,)).fetchone())
+    finally:
+        conn.close()
+
+
+def test_reading_gamification_writes_nothing(main, client):
+    client, user_id = client
+    add_generation(main, user_id, "Instagram")
+    version = main.user_data_version(user_id)
+
+    first = client.get("/gamification").json()
+    second = client.get("/gamification").json()
+
+    assert [b["id"] for b in first["new_badges"]] == ["first_gen"]
+    assert second["new_badges"] == first["new_badges"]  # still unseen: nothing acknowledged them
+    assert main.user_data_version(user_id) == version
+
+
+def test_seen_badges_are_dropped_and_later_ones_kept(main, client):
+    client, user_id = client
+    add_generation(main, user_id, "Instagram")
+    shown = [b["id"] for b in client.get("/gamification").json()["new_badges"]]
+    main.db_writer.run(lambda conn: conn.execute(
+        "UPDATE users SET badges_unseen = ? WHERE id = ?", (json.dumps(shown + ["later"]), user_id)))
+
+    assert client.post("/gamification/seen", json={"badges": shown}).status_code == 200
+
+    assert json.loads(counters(main, user_id)["badges_unseen"]) == ["later"]
+    assert client.get("/gamification").json()["new_badges"] == []  # "later" isn't a defined badge
+
+
+def test_generations_without_a_platform_are_not_a_platform(main, make_user):
+    user_id = make_user()
+    add_generation(main, user_id, "")
+    add_generation(main, user_id, None)
+    assert counters(main, user_id)["platform_count"] == 0
+
+    add_generation(main, user_id, "Instagram")
+    add_generation(main, user_id, "LinkedIn")
+    assert counters(main, user_id)["platform_count"] == 2
+
+    conn = main.get_db()
+    try:
+        assert main.check_gamification_counters(conn) == 0  # the triggers and the recount agree
+    finally:
+        conn.close()
+
+
+def test_platform_migration_repairs_counts_that_included_blanks(main, make_user):
+    user_id = make_user()
+    add_generation(main, user_id, "")
+    add_generation(main, user_id, "Instagram")
+    main.db_writer.run(lambda conn: conn.execute("UPDATE users SET platform_count = 2 WHERE id = ?", (user_id,)))
+
+    conn = main.get_db()
+    try:
+        conn.execute("BEGIN IMMEDIATE")  # as run_migrations does
+        main.migrate_platform_counters(conn)
+        conn.commit()
+    finally:
+        conn.close()
+    assert counters(main, user_id)["platform_count"] == 1
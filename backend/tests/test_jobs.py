@@ -0,0 +1,133 @@
+import asyncio
+import sqlite3
+import time
+
+
+def enqueue(main, user_id, kind="generate", created_at=None, batch_id=""):
+    def write(conn):
+        job_id = main.enqueue_job(conn, user_id, kind, {}, batch_id=batch_id)
+        if created_at:
+            conn.execute("UPDATE jobs SET created_at = ? WHERE id = ?", (created_at, job_id))
+        return job_id
+    return main.db_writer.run(write)
+
+
+def test_claim_waits_for_the_write_lock_off_the_event_loop(main, make_user):
+    job_id = enqueue(main, make_user())
+
+    async def scenario():
+        holder = sqlite3.connect(main.DATABASE_PATH)
+        holder.execute("BEGIN IMMEDIATE")
+        asyncio.get_running_loop().call_later(0.5, holder.rollback)
+        claim = asyncio.ensure_future(main.db_writer.run_async(main.claim_job))
+        started, gaps = time.monotonic(), []
+        while not claim.done():
+            tick = time.monotonic()
+            await asyncio.sleep(0.01)
+            gaps.append(time.monotonic() - tick)
+        holder.close()
+        return await claim, time.monotonic() - started, max(gaps)
+
+    job, waited, worst_gap = asyncio.run(scenario())
+    assert job["id"] == job_id and job["status"] == "running"
+    assert waited >= 0.4  # it really did wait for the lock...
+    assert worst_gap < 0.2  # ...without stalling the loop
+
+
+def test_update_job_renews_the_lease(main, make_user):
+    job_id = enqueue(main, make_user())
+    main.db_writer.run(main.claim_job)
+    main.db_writer.run(lambda conn: main.update_job(conn, job_id, status="running", stage="text"))
+    conn = main.get_db()
+    try:
+        row = conn.execute("SELECT stage, lease_until FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    finally:
+        conn.close()
+    assert row["stage"] == "text"
+    assert row["lease_until"] > time.time() + main.JOB_LEASE_SECONDS - 5
+
+
+def test_expired_lease_is_claimed_again(main, make_user):
+    job_id = enqueue(main, make_user())
+    main.db_writer.run(main.claim_job)
+    main.db_writer.run(lambda conn: conn.execute("UPDATE jobs SET lease_until = 0 WHERE id = ?", (job_id,)))
+    job = main.db_writer.run(main.claim_job)
+    assert job["id"] == job_id and job["attempts"] == 2
+
+
+def test_campaign_batch_does_not_starve_another_users_single_job(main, make_user, monkeypatch):
+    monkeypatch.setattr(main, "JOB_USER_CONCURRENCY", 3)
+    heavy, light = make_user(), make_user()
+    batch = [enqueue(main, heavy, "campaign_post", created_at=f"2026-01-01 00:00:0{i}", batch_id="b") for i in range(7)]
+    single = enqueue(main, light, created_at="2026-01-01 00:01:00")
+
+    # One worker claiming in turn: the light user's newer job goes second, ahead of six older batch posts
+    claimed = [main.db_writer.run(main.claim_job) for _ in range(5)]
+    assert [job["id"] if job else None for job in claimed] == [batch[0], single, batch[1], batch[2], None]
+
+    # the cap holds the rest of the batch until one of its posts finishes
+    main.db_writer.run(lambda conn: main.update_job(conn, batch[0], status="done"))
+    assert main.db_writer.run(main.claim_job)["id"] == batch[3]
+
+
+def test_workers_outlast_a_lock_held_past_busy_timeout(main, make_user, monkeypatch):
+    monkeypatch.setattr(main, "JOB_DB_RETRY", (0.05, 0.2))
+    handled = []
+
+    async def handler(job):
+        handled.append(job["id"])
+        if len(handled) == 2:
+            # another process takes the write lock while this job runs, so finishing it has to wait
+            lock_writes(0.5)
+        return {"ok": True}
+
+    monkeypatch.setitem(main.JOB_HANDLERS, "generate", handler)
+    user_id = make_user()
+    first = enqueue(main, user_id)
+    # writes give up on the lock after 100ms instead of 5s, as if it were held past busy_timeout
+    main.db_writer.stop()
+    for conn in list(main._db_pool._idle.queue):
+        conn.execute("PRAGMA busy_timeout = 100")
+
+    def lock_writes(seconds):
+        holder = sqlite3.connect(main.DATABASE_PATH)
+        holder.execute("BEGIN IMMEDIATE")
+        asyncio.get_running_loop().call_later(seconds, lambda: (holder.rollback(), holder.close()))
+
+    def status(job_id):
+        conn = main.get_db()
+        try:
+            return conn.execute("SELECT status, attempts FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        finally:
+            conn.close()
+
+    async def until_done(job_id):
+        while status(job_id)["status"] != "done":
+            await asyncio.sleep(0.05)
+
+    async def scenario():
+        lock_writes(1.0)  # claims fail for a second
+        await main.start_job_workers()
+        await asyncio.sleep(0.5)
+        assert not any(worker.done() for worker in main._job_workers)
+        await asyncio.wait_for(until_done(first), timeout=10)
+
+        second = await main.db_writer.run_async(lambda conn: main.enqueue_job(conn, user_id, "generate", {}))
+        main.notify_job_workers()
+        await asyncio.wait_for(until_done(second), timeout=10)
+        await main.stop_job_workers()
+        return second
+
+    second = asyncio.run(scenario())
+    assert handled == [first, second]  # the finish was retried, not the job
+    assert status(second)["attempts"] == 1
+
+
+def test_stopping_idle_workers_as_they_are_woken(main):
+    async def scenario():
+        await main.start_job_workers()
+        await asyncio.sleep(0.2)  # every worker is idle, waiting for a wakeup
+        main.get_job_wakeup().set()
+        await asyncio.wait_for(main.stop_job_workers(), timeout=5)
+
+    asyncio.run(scenario())
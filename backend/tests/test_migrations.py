@@ -0,0 +1,63 @@
+import os
+import re
+import shutil
+import sqlite3
+import subprocess
+import sys
+
+import pytest
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_workers_migrating_the_bundled_database_together(main, tmp_path):
+    """What `uvicorn --workers 4` does on its first start against the shipped database"""
+    db = str(tmp_path / "bundled.db")
+    shutil.copy(os.path.join(BACKEND, "content_studio.db"), db)
+    env = {**os.environ, "GEMINI_API_KEY": "test", "IMAGE_STORE_DIR": str(tmp_path / "images"), "PYTHONWARNINGS": "ignore"}
+    code = f"import main; main.DATABASE_PATH = {db!r}; main.init_db()"
+    workers = [subprocess.Popen([sys.executable, "-c", code], cwd=BACKEND, env=env, text=True,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE) for _ in range(4)]
+    outputs = [worker.communicate(timeout=120) for worker in workers]
+
+    assert [worker.returncode for worker in workers] == [0] * 4, [err for _, err in outputs]
+    applied = [int(n) for out, _ in outputs for n in re.findall(r"Applied database migration (\d+)", out)]
+    for target in range(1, len(main.MIGRATIONS) + 1):
+        # migration 9 re-runs after each worker's own VACUUM; everything else is applied exactly once
+        assert applied.count(target) >= 1 if target == 9 else applied.count(target) == 1, target
+
+    conn = sqlite3.connect(db)
+    try:
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == len(main.MIGRATIONS)
+        conn.execute("INSERT INTO generations_fts(generations_fts) VALUES ('integrity-check')")
+        for user_id, rows in conn.execute("SELECT user_id, COUNT(*) FROM generations GROUP BY user_id").fetchall():
+            token = user_id.replace("-", "")
+            assert conn.execute("SELECT COUNT(*) FROM generations_fts WHERE generations_fts MATCH ?",
+                                (f'user_id:"{token}"',)).fetchone()[0] == rows
+    finally:
+        conn.close()
+
+
+def test_a_failed_migration_leaves_the_previous_version(main, monkeypatch):
+    version = len(main.MIGRATIONS)
+
+    def half_done(conn):
+        conn.execute("ALTER TABLE users ADD COLUMN nickname TEXT DEFAULT ''")
+        raise RuntimeError("crashed part-way")
+
+    monkeypatch.setattr(main, "MIGRATIONS", main.MIGRATIONS + [half_done])
+    conn = main.get_db()
+    try:
+        with pytest.raises(RuntimeError):
+            main.run_migrations(conn)
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == version
+        assert "nickname" not in {r["name"] for r in conn.execute("PRAGMA table_info(users)")}
+
+        # the next start applies it from scratch, and the one after that has nothing to do
+        monkeypatch.setattr(main, "MIGRATIONS", main.MIGRATIONS[:-1] + ["ALTER TABLE users ADD COLUMN nickname TEXT DEFAULT '';"])
+        main.run_migrations(conn)
+        main.run_migrations(conn)
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == version + 1
+        assert conn.execute("PRAGMA busy_timeout").fetchone()[0] == 5000
+    finally:
+        conn.close()
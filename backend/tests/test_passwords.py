@@ -0,0 +1,39 @@
+import asyncio
+import concurrent.futures
+import hashlib
+
+
+class BrokenPool:
+    """A process pool whose workers die on every hash"""
+    created = []
+
+    def __init__(self, **kwargs):
+        self.shutdown_args = None
+        BrokenPool.created.append(self)
+
+    def submit(self, fn, *args):
+        future = concurrent.futures.Future()
+        future.set_exception(concurrent.futures.process.BrokenProcessPool("worker died"))
+        return future
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        self.shutdown_args = (wait, cancel_futures)
+
+
+def test_broken_pools_are_shut_down_then_abandoned(main, monkeypatch):
+    BrokenPool.created = []
+    monkeypatch.setattr(main, "ProcessPoolExecutor", BrokenPool)
+    monkeypatch.setattr(main, "_password_pool", None)
+    monkeypatch.setattr(main, "_password_pool_breaks", 0)
+
+    async def sign_ins(n):
+        return [await main.pbkdf2("secret", "salt", 1000) for _ in range(n)]
+
+    hashes = asyncio.run(sign_ins(6))
+
+    # every sign-in still gets the right hash, from the thread fallback
+    assert set(hashes) == {hashlib.pbkdf2_hmac("sha256", b"secret", b"salt", 1000).hex()}
+    # each broken pool was shut down without waiting, and respawning stopped after the limit
+    assert len(BrokenPool.created) == main.PASSWORD_POOL_MAX_BREAKS
+    assert all(pool.shutdown_args == (False, True) for pool in BrokenPool.created)
+    assert main._password_pool is None
@@ -0,0 +1,119 @@
+import re
+import uuid
+
+import pytest
+
+from test_jobs import enqueue
+
+
+def seed_generations(main, user_id, n=5):
+    def write(conn):
+        for i in range(n):
+            conn.execute(
+                "INSERT INTO generations (id, user_id, brand_name, platform, tone, share_id, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (str(uuid.uuid4()), user_id, "Brand", "Instagram", "Festive", f"share-{user_id}-{i}",
+                 f"2026-01-01 00:00:0{i}"))
+    main.db_writer.run(write)
+
+
+@pytest.fixture
+def traced(main, monkeypatch):
+    """Records every statement run on connections from get_db()"""
+    statements = []
+    get_db = main.get_db
+
+    def traced_get_db():
+        conn = get_db()
+        conn.set_trace_callback(statements.append)
+        return conn
+
+    monkeypatch.setattr(main, "get_db", traced_get_db)
+    yield statements
+    for conn in list(main._db_pool._idle.queue):
+        conn.set_trace_callback(None)
+
+
+def assert_indexed(main, statements):
+    """EXPLAIN QUERY PLAN each traced query: no full table scans, no temp b-tree sorts"""
+    conn = main.get_db()
+    try:
+        tables = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        queries = [s for s in statements if s.split(None, 1)[0].upper() in ("SELECT", "WITH", "UPDATE", "DELETE")]
+        assert queries
+        for sql in queries:
+            plan = [r["detail"] for r in conn.execute("EXPLAIN QUERY PLAN " + sql)]
+            for step in plan:
+                scan = re.fullmatch(r"SCAN (\w+)", step)
+                assert not (scan and scan.group(1) in tables), f"full scan in {sql!r}: {plan}"
+                assert "USE TEMP B-TREE" not in step, f"temp b-tree in {sql!r}: {plan}"
+    finally:
+        conn.close()
+
+
+def test_history_pages_use_the_index(main, make_user, traced):
+    user = {"user_id": make_user()}
+    seed_generations(main, user["user_id"])
+    page = main.get_history(user=user, limit=2)
+    main.get_history(user=user, limit=2, cursor=page["next_cursor"], count="estimate")
+    main.get_history(user=user, limit=2, offset=2, count="none")
+    assert_indexed(main, traced)
+
+
+def test_share_lookup_uses_the_index(main, make_user, traced):
+    user_id = make_user()
+    seed_generations(main, user_id, n=1)
+    main.get_shared(f"share-{user_id}-0")
+    assert_indexed(main, traced)
+
+
+def test_analytics_reads_the_rollups_by_key(main, make_user, traced):
+    user = {"user_id": make_user()}
+    seed_generations(main, user["user_id"])
+    assert main.get_analytics(user=user)["total_generations"] == 5
+    assert_indexed(main, traced)
+
+
+def test_job_claim_uses_the_index(main, make_user, traced):
+    heavy, light = make_user(), make_user()
+    for _ in range(3):
+        enqueue(main, heavy, "campaign_post", batch_id="b")
+    enqueue(main, light)
+    main.db_writer.run(main.claim_job)  # one running job, so both branches of the claim have rows
+    conn = main.get_db()
+    try:
+        assert main.claim_job(conn)
+    finally:
+        conn.rollback()
+        conn.close()
+    assert_indexed(main, traced)
+
+
+def test_listings_use_the_index(main, client, traced):
+    http, user_id = client
+    seed_generations(main, user_id)
+
+    def write(conn):
+        generation_id = conn.execute("SELECT id FROM generations WHERE user_id = ? LIMIT 1", (user_id,)).fetchone()[0]
+        conn.execute("UPDATE generations SET scheduled_date = '2026-02-01', is_evergreen = 1 WHERE id = ?", (generation_id,))
+        conn.execute("INSERT INTO brands (id, user_id, name) VALUES (?, ?, 'Brand')", (str(uuid.uuid4()), user_id))
+        conn.execute("INSERT INTO campaigns (id, user_id, name) VALUES (?, ?, 'Launch')", (str(uuid.uuid4()), user_id))
+        conn.execute("INSERT INTO approvals (id, generation_id, user_id) VALUES (?, ?, ?)", (str(uuid.uuid4()), generation_id, user_id))
+    main.db_writer.run(write)
+
+    for path in ("/brands", "/campaigns", "/scheduled", "/evergreen", "/approvals"):
+        r = http.get(path)
+        assert r.status_code == 200 and len(r.json()) == 1, (path, r.text)
+    assert_indexed(main, traced)
+
+
+def test_campaign_batch_progress_uses_the_index(main, client, traced):
+    http, user_id = client
+    job_ids = main.db_writer.run(lambda conn: [
+        main.enqueue_job(conn, user_id, "campaign_post", {"campaign_id": "c1", "day": day, "scheduled_date": "2026-02-01"}, batch_id="b1")
+        for day in range(3)])
+
+    r = http.get("/campaigns/c1/generate/b1")
+    assert r.status_code == 200
+    assert [p["job_id"] for p in r.json()["posts"]] == job_ids
+    assert_indexed(main, traced)
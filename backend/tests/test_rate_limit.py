@@ -0,0 +1,48 @@
+import asyncio
+import sqlite3
+import time
+
+import pytest
+from fastapi import HTTPException
+
+
+@pytest.fixture
+def sqlite_limiter(main, tmp_path, monkeypatch):
+    path = str(tmp_path / "rate_limits.db")
+    monkeypatch.setattr(main, "rate_limiter", main.SQLiteRateLimiter(path))
+    return path
+
+
+def test_async_check_waits_for_another_workers_lock_off_the_event_loop(main, sqlite_limiter):
+    async def scenario():
+        other_worker = sqlite3.connect(sqlite_limiter)
+        other_worker.execute("BEGIN IMMEDIATE")
+        asyncio.get_running_loop().call_later(0.5, other_worker.rollback)
+        check = asyncio.ensure_future(main.check_rate_limit_async("user", max_calls=2, window_seconds=60))
+        started, gaps = time.monotonic(), []
+        while not check.done():
+            tick = time.monotonic()
+            await asyncio.sleep(0.01)
+            gaps.append(time.monotonic() - tick)
+        other_worker.close()
+        await check
+        return time.monotonic() - started, max(gaps)
+
+    waited, worst_gap = asyncio.run(scenario())
+    assert waited >= 0.4  # it really did wait for the lock...
+    assert worst_gap < 0.2  # ...without stalling the loop
+
+
+@pytest.mark.parametrize("backend", ["memory", "sqlite"])
+def test_async_check_enforces_the_limit(main, tmp_path, monkeypatch, backend):
+    limiter = main.SQLiteRateLimiter(str(tmp_path / "rl.db")) if backend == "sqlite" else main.MemoryRateLimiter()
+    monkeypatch.setattr(main, "rate_limiter", limiter)
+
+    async def calls(n):
+        for _ in range(n):
+            await main.check_rate_limit_async("user", max_calls=3, window_seconds=60)
+
+    asyncio.run(calls(3))
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(calls(1))
+    assert exc.value.status_code == 429 and int(exc.value.headers["Retry-After"]) >= 1
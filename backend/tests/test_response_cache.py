@@ -0,0 +1,45 @@
+import sqlite3
+import uuid
+
+
+def insert_brand(path, user_id, name):
+    """Write straight to the database, the way another worker process would"""
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute("INSERT INTO brands (id, user_id, name) VALUES (?, ?, ?)", (str(uuid.uuid4()), user_id, name))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def test_cached_list_revalidates_with_etag(main, client):
+    client, _ = client
+    first = client.get("/brands")
+    assert first.status_code == 200 and first.json() == []
+    again = client.get("/brands", headers={"If-None-Match": first.headers["etag"]})
+    assert again.status_code == 304
+
+
+def test_another_workers_write_invalidates_the_cache(main, client):
+    client, user_id = client
+    etag = client.get("/brands").headers["etag"]
+
+    insert_brand(main.DATABASE_PATH, user_id, "Elsewhere")
+
+    fresh = client.get("/brands", headers={"If-None-Match": etag})
+    assert fresh.status_code == 200
+    assert [b["name"] for b in fresh.json()] == ["Elsewhere"]
+
+
+def test_version_moves_with_the_write_that_commits(main, make_user):
+    user_id = make_user()
+    before = main.user_data_version(user_id)
+
+    conn = sqlite3.connect(main.DATABASE_PATH)
+    conn.execute("INSERT INTO brands (id, user_id, name) VALUES (?, ?, ?)", (str(uuid.uuid4()), user_id, "Rolled back"))
+    conn.rollback()
+    conn.close()
+    assert main.user_data_version(user_id) == before
+
+    insert_brand(main.DATABASE_PATH, user_id, "Kept")
+    assert main.user_data_version(user_id) > before
@@ -0,0 +1,32 @@
+import uuid
+
+
+def add_generation(main, user_id, topic, script):
+    main.db_writer.run(lambda conn: conn.execute(
+        "INSERT INTO generations (id, user_id, topic, script) VALUES (?, ?, ?, ?)",
+        (str(uuid.uuid4()), user_id, topic, script)))
+
+
+def search(main, user_id, q):
+    return main.search_history(q=q, user={"user_id": user_id})["items"]
+
+
+def test_terms_do_not_match_the_tenant_token(main, make_user):
+    user_id = make_user()
+    add_generation(main, user_id, "Diwali sale", "Lamps for every home")
+    add_generation(main, user_id, "Holi colours", "Bright powders")
+    add_generation(main, user_id, "Eid feast", "Sweets to share")
+    token = user_id.replace("-", "")
+
+    assert [r["topic"] for r in search(main, user_id, "diwali")] == ["Diwali sale"]
+    assert search(main, user_id, token[:8]) == []
+    assert search(main, user_id, token) == []
+
+
+def test_snippets_are_escaped_around_the_highlights(main, make_user):
+    user_id = make_user()
+    add_generation(main, user_id, "Launch", '<img src=x onerror="alert(1)"> Diwali & more')
+
+    (item,) = search(main, user_id, "diwali")
+
+    assert item["script_snippet"] == "&lt;img src=x onerror=&quot;alert(1)&quot;&gt; <mark>Diwali</mark> &amp; more"
@@ -0,0 +1,109 @@
+import asyncio
+
+import httpx
+import pytest
+
+from fake_upstream import FakeUpstream
+
+
+@pytest.fixture
+def pollinations(main, monkeypatch):
+    """Route fetch_pollinations_image to a fake upstream, through a fresh scheduler"""
+    def install(upstream: FakeUpstream, ceiling: int = 16):
+        scheduler = main.FairScheduler("pollinations", ceiling)
+        monkeypatch.setattr(main, "pollinations_scheduler", scheduler)
+        monkeypatch.setattr(main, "_pollinations_client", upstream.client(main.POLLINATIONS_BASE_URL))
+        return scheduler
+    return install
+
+
+async def fetch(main, user_id="", lane="interactive"):
+    main.upstream_caller.set((user_id, lane))
+    try:
+        return (await main.fetch_pollinations_image("prompt")).status_code
+    except httpx.TimeoutException:
+        return "timeout"
+
+
+async def load(main, callers: int, calls: int, user_id=""):
+    """`callers` concurrent clients making `calls` requests between them.
+    Returns (status, scheduler limit just after) per call, in completion order."""
+    results = []
+
+    async def caller(n):
+        for _ in range(n):
+            status = await fetch(main, user_id)
+            results.append((status, main.pollinations_scheduler.limit.value))
+
+    await asyncio.gather(*(caller(calls // callers) for _ in range(callers)))
+    return results
+
+
+# A timeout reports the overload `timeout` seconds after the probe that caused it, and the probe
+# holds its slot until then, so the limit settles higher than on an immediate 429
+@pytest.mark.parametrize("overload, max_limit, max_refused", [("429", 5, 0.1), ("timeout", 7.5, 0.2)])
+def test_limit_backs_off_to_what_the_upstream_serves(main, pollinations, overload, max_limit, max_refused):
+    upstream = FakeUpstream(capacity=4, overload=overload)
+    scheduler = pollinations(upstream)  # starts at 8 of 16
+
+    results = asyncio.run(load(main, callers=32, calls=640))
+
+    assert scheduler.limit.epoch > 0
+    # AIMD saws around what the upstream serves; average over the second half of the run
+    settled = [limit for _, limit in results[len(results) // 2:]]
+    assert sum(settled) / len(settled) <= max_limit
+    # it probes past the upstream's capacity now and then, but most calls get through
+    assert [status for status, _ in results].count(200) == upstream.served
+    assert upstream.refused < len(results) * max_refused
+
+
+def test_limit_recovers_additively(main, pollinations):
+    upstream = FakeUpstream(capacity=4)
+    scheduler = pollinations(upstream)
+    asyncio.run(load(main, callers=32, calls=320))
+    backed_off, epoch = scheduler.limit.value, scheduler.limit.epoch
+    assert epoch > 0
+
+    # the upstream has room again: +1 per window of healthy calls, never a jump
+    upstream.capacity = 64
+    values = [backed_off]
+    for _ in range(10):
+        asyncio.run(load(main, callers=32, calls=64))
+        values.append(scheduler.limit.value)
+    assert scheduler.limit.epoch == epoch
+    # 64 healthy calls at limit v add at most 64 / v
+    assert all(0 < after - before <= 64 / before for before, after in zip(values, values[1:]) if before < 16)
+    assert scheduler.capacity == scheduler.limit.ceiling
+
+
+def test_additive_increase_is_one_slot_per_window(main):
+    limit = main.AdaptiveLimit(16)
+    limit.on_overload(limit.epoch)
+    assert limit.value == 4
+    for _ in range(4):
+        limit.on_success(0.01)
+    assert 4.8 < limit.value < 5  # a window of 4 calls buys one slot, not a doubling
+    limit.on_overload(0)  # a call from before the last cut doesn't cut again
+    assert limit.value > 4.8
+
+
+def test_heavy_tenant_does_not_starve_a_light_one(main, pollinations):
+    upstream = FakeUpstream(capacity=64)
+    scheduler = pollinations(upstream, ceiling=2)
+    scheduler.limit.value = 2.0
+    finished = []
+
+    async def call(user_id):
+        await fetch(main, user_id, lane="batch")
+        finished.append(user_id)
+
+    async def scenario():
+        heavy = [asyncio.create_task(call("heavy")) for _ in range(30)]
+        await asyncio.sleep(0)  # the heavy backlog is queued first
+        light = [asyncio.create_task(call("light")) for _ in range(2)]
+        await asyncio.gather(*heavy, *light)
+
+    asyncio.run(scenario())
+    # interleaved with the backlog rather than served after it
+    positions = [i for i, user_id in enumerate(finished) if user_id == "light"]
+    assert len(positions) == 2 and max(positions) < 6
@@ -1,5 +1,8 @@
 const API_BASE = import.meta.env.VITE_API_URL || 'http://localhost:8000';
 
+// Stored images come back as API-relative paths like /images/<hash>
+export const assetUrl = (url) => (url && url.startsWith('/') ? `${API_BASE}${url}` : url);
+
 export const api = {
     get: async (path, auth = true) => {
         const headers = { 'Content-Type': 'application/json' };
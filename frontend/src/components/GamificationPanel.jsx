@@ -8,7 +8,11 @@ const GamificationPanel = () => {
     const [loading, setLoading] = useState(true);
 
     useEffect(() => {
-        api.get('/gamification').then(d => { setData(d); setLoading(false); }).catch(() => setLoading(false));
+        api.get('/gamification').then(d => {
+            setData(d);
+            setLoading(false);
+            if (d.new_badges?.length) api.post('/gamification/seen', { badges: d.new_badges.map(b => b.id) }).catch(() => {});
+        }).catch(() => setLoading(false));
     }, []);
 
     if (loading) return <div className="page-container"><div className="empty-state"><div className="spinner-lg" /></div></div>;
@@ -2,7 +2,7 @@ import { useState, useEffect } from 'react';
 import { motion, AnimatePresence } from 'framer-motion';
 import { useNavigate } from 'react-router-dom';
 import { History as HistoryIcon, Search, Trash2, ExternalLink, Image, MessageSquare, Filter, ChevronLeft, ChevronRight } from 'lucide-react';
-import api from '../api';
+import api, { assetUrl } from '../api';
 import { GridSkeleton } from './Skeleton';
 
 const HistoryPage = () => {
@@ -12,18 +12,21 @@ const HistoryPage = () => {
     const [search, setSearch] = useState('');
     const [platformFilter, setPlatformFilter] = useState('');
     const [page, setPage] = useState(0);
+    const [cursors, setCursors] = useState([null]);
     const navigate = useNavigate();
     const perPage = 12;
 
     const fetchHistory = async () => {
         setLoading(true);
         try {
-            let path = `/history?limit=${perPage}&offset=${page * perPage}`;
+            let path = `/history?limit=${perPage}`;
+            if (cursors[page]) path += `&cursor=${encodeURIComponent(cursors[page])}`;
             if (search) path += `&brand=${encodeURIComponent(search)}`;
             if (platformFilter) path += `&platform=${encodeURIComponent(platformFilter)}`;
             const data = await api.get(path);
             setItems(data.items);
             setTotal(data.total);
+            setCursors(prev => [...prev.slice(0, page + 1), data.next_cursor]);
         } catch (e) {
             console.error(e);
         } finally {
@@ -46,8 +49,10 @@ const HistoryPage = () => {
         alert('Share link copied!');
     };
 
-    const handleOpen = (item) => {
-        navigate('/result', { state: { data: item } });
+    const handleOpen = async (item) => {
+        // List rows are the summary shape; the result view needs the full generation
+        const full = await api.get(`/history/${item.id}`).catch(() => item);
+        navigate('/result', { state: { data: full } });
     };
 
     const totalPages = Math.ceil(total / perPage);
@@ -118,7 +123,7 @@ const HistoryPage = () => {
                             >
                                 {item.image_url && (
                                     <div className="history-card__image">
-                                        <img src={item.image_url} alt="" loading="lazy" />
+                                        <img src={assetUrl(item.image_url)} alt="" loading="lazy" />
                                     </div>
                                 )}
                                 <div className="history-card__body">
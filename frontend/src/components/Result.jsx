@@ -1,7 +1,7 @@
 import { motion } from 'framer-motion';
 import { Copy, ArrowLeft, Check, Sparkles, Image as ImageIcon, MessageSquare, Send } from 'lucide-react';
 import { useLocation, Link } from 'react-router-dom';
-import { useState } from 'react';
+import { useState, useEffect } from 'react';
 import BlurText from './reactbits/BlurText';
 import StarBorder from './reactbits/StarBorder';
 import ExportSuite from './ExportSuite';
@@ -10,7 +10,7 @@ import PlatformPreview from './PlatformPreview';
 import ContentRepurposer from './ContentRepurposer';
 import QRCodeWidget from './QRCodeWidget';
 import { ToneAnalyzer, ReadabilityWidget, EngagementPredictor } from './ContentAnalyzers';
-import api from '../api';
+import api, { assetUrl } from '../api';
 
 const Result = () => {
     const location = useLocation();
@@ -22,6 +22,27 @@ const Result = () => {
     const [editedScript, setEditedScript] = useState('');
     const [activeVariation, setActiveVariation] = useState(0);
     const [submitted, setSubmitted] = useState(false);
+    const [lateImages, setLateImages] = useState({});
+
+    // Images that missed the request deadline arrive later; poll their image_deferred references
+    useEffect(() => {
+        const items = data?.variations?.length ? data.variations : (data ? [data] : []);
+        let waiting = items.filter(v => v.image_deferred && !v.image_url);
+        if (!waiting.length) return;
+        const timer = setInterval(async () => {
+            const still = [];
+            for (const v of waiting) {
+                try {
+                    const res = await api.get(v.image_deferred);
+                    if (res.status === 'ready') setLateImages(m => ({ ...m, [v.id]: res.image_url }));
+                    else if (res.status === 'pending') still.push(v);
+                } catch (e) { console.error(e); }
+            }
+            waiting = still;
+            if (!waiting.length) clearInterval(timer);
+        }, 3000);
+        return () => clearInterval(timer);
+    }, [data]);
 
     if (!data) return (
         <div className="page-container" style={{ textAlign: 'center', marginTop: '10vh' }}>
@@ -34,7 +55,7 @@ const Result = () => {
     const currentData = isVariations ? data.variations[activeVariation] : data;
     const script = editedScript || currentData.script || '';
     const visualPrompt = currentData.visual_prompt || '';
-    const imageUrl = currentData.image_url || '';
+    const imageUrl = assetUrl(currentData.image_url || lateImages[currentData.id]) || '';
     const shareId = currentData.share_id || '';
     const genId = currentData.id || '';
 
@@ -164,7 +185,7 @@ const Result = () => {
                                 <div className="result-image-overlay" />
                             </div>
                         ) : (
-                            <div className="result-image-placeholder">No Preview Available</div>
+                            <div className="result-image-placeholder">{currentData.image_deferred && !(currentData.id in lateImages) ? 'Image still rendering…' : 'No Preview Available'}</div>
                         )}
 
                         <div className="result-prompt-box">
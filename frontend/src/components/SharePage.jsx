@@ -2,7 +2,7 @@ import { useState, useEffect } from 'react';
 import { motion } from 'framer-motion';
 import { useParams, Link } from 'react-router-dom';
 import { ArrowLeft, Copy, Check } from 'lucide-react';
-import api from '../api';
+import api, { assetUrl } from '../api';
 
 const SharePage = () => {
     const { shareId } = useParams();
@@ -65,7 +65,7 @@ const SharePage = () => {
                 {data.image_url && (
                     <div className="glass-card" style={{ padding: '24px' }}>
                         <h3 style={{ fontWeight: 600, marginBottom: '16px' }}>🎨 Generated Visual</h3>
-                        <img src={data.image_url} alt="Generated" style={{ width: '100%', borderRadius: '12px' }} />
+                        <img src={assetUrl(data.image_url)} alt="Generated" style={{ width: '100%', borderRadius: '12px' }} />
                     </div>
                 )}
 